@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""Benchmark the authentication, the permission check and the APIClient header generation.
+
+Every scenario runs with a cold and a warm cache, ``--agents`` API agents holding
+``--permissions`` permissions each and every thread count of ``--threads``. It reports the
+ops/sec, the latency percentiles and the DB queries per call, and writes the results as JSON so
+two runs can be compared.
+
+    python benchmarks/bench_auth.py --agents 10 --permissions 50 --threads 1,4 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from uuid import uuid4
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "src"), os.path.join(ROOT, "tests")]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.contrib.auth.models import (  # noqa: E402
+    AnonymousUser,
+    Group,
+    Permission,
+    User,
+)
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.http import HttpRequest  # noqa: E402
+from jose import jwt  # noqa: E402
+from rest_framework.request import Request  # noqa: E402
+
+from core.views import UserViewSet  # noqa: E402
+from ponddy_auth.agents import api_agent_cache, resolve_api_agent  # noqa: E402
+from ponddy_auth.authentication import (  # noqa: E402
+    API_AGENT_PROPERTY_NAME,
+    SSOAuthentication,
+    attach_permission_functions,
+    get_api_agent_group_name,
+)
+from ponddy_auth.permissions import SSODjangoModelPermissions  # noqa: E402
+from ponddy_auth.utils import APIClient  # noqa: E402
+
+SECRET = "SECRET"
+PERCENTILES = (50, 90, 99)
+
+
+class Agent(typing.NamedTuple):
+    api: str
+    email: str
+    group: Group
+    token: str
+
+
+class Scenario(typing.NamedTuple):
+    name: str
+    cache: str
+    prepare: typing.Callable[[int], typing.Any]
+    call: typing.Callable[[typing.Any], typing.Any]
+
+
+class UpstreamResponse:
+    ok = True
+    status_code = 200
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class QueryCounter:
+    """Count the queries of the current thread while ``active`` is set."""
+
+    def __init__(self) -> None:
+        self.active = False
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):  # type: ignore
+        if self.active:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def set_up_agents(agents: int, permissions: int) -> typing.List[Agent]:
+    content_type = ContentType.objects.get_for_model(User)
+    view_user = Permission.objects.get(codename="view_user", content_type=content_type)
+    result = []
+    for index in range(agents):
+        api = str(uuid4())
+        group = Group.objects.create(name=get_api_agent_group_name({"api": api}))
+        granted = Permission.objects.bulk_create(
+            Permission(
+                name=f"bench {index} {number}",
+                codename=f"bench_{index}_{number}",
+                content_type=content_type,
+            )
+            for number in range(permissions - 1)
+        )
+        group.permissions.add(view_user, *granted)
+        email = f"agent{index}@bench.local"
+        User.objects.create(username=email, email=email)
+        token = "SSO {}".format(jwt.encode({"email": email, "api": api}, SECRET))
+        result.append(Agent(api=api, email=email, group=group, token=token))
+    return result
+
+
+def clear_caches() -> None:
+    SSOAuthentication.token_cache.clear()
+    SSOAuthentication.rejected_token_cache.clear()
+    api_agent_cache.clear()
+
+
+def get_scenarios(agents: typing.List[Agent]) -> typing.List[Scenario]:
+    authentication = SSOAuthentication()
+    permission = SSODjangoModelPermissions()
+    view = UserViewSet()
+    client = APIClient(app_name="APP", api_client_id=agents[0].api, api_secret=SECRET)
+
+    def get_auth_request(index: int) -> HttpRequest:
+        request = HttpRequest()
+        request.META = {"HTTP_AUTHORIZATION": agents[index % len(agents)].token}
+        return request
+
+    def prepare_cold_authenticate(index: int) -> HttpRequest:
+        clear_caches()
+        return get_auth_request(index)
+
+    def get_permission_request(agent: Group) -> Request:
+        attach_permission_functions(agent)
+        http_request = HttpRequest()
+        http_request.method = "GET"
+        request = Request(http_request)
+        user = AnonymousUser()
+        setattr(user, API_AGENT_PROPERTY_NAME, agent)
+        request.user = user
+        return request
+
+    def prepare_cold_permission(index: int) -> Request:
+        group = agents[index % len(agents)].group
+        return get_permission_request(Group(id=group.id, name=group.name))
+
+    def prepare_warm_permission(index: int) -> Request:
+        return get_permission_request(resolve_api_agent(agents[index % len(agents)].group.name))
+
+    def refresh_api_header(_: None) -> None:
+        client.refresh_api_header()
+
+    def read_api_header(_: None) -> typing.Any:
+        # What APIClient.request does per request once the header is signed
+        if client.api_header_expiring():
+            client.refresh_api_header()
+        return client.headers["Authorization"]
+
+    return [
+        Scenario("authenticate", "cold", prepare_cold_authenticate, authentication.authenticate),
+        Scenario("authenticate", "warm", get_auth_request, authentication.authenticate),
+        Scenario(
+            "has_permission",
+            "cold",
+            prepare_cold_permission,
+            lambda request: permission.has_permission(request, view),
+        ),
+        Scenario(
+            "has_permission",
+            "warm",
+            prepare_warm_permission,
+            lambda request: permission.has_permission(request, view),
+        ),
+        Scenario("api_client_header", "cold", lambda index: None, refresh_api_header),
+        Scenario("api_client_header", "warm", lambda index: None, read_api_header),
+    ]
+
+
+def percentile(latencies: typing.List[float], percent: float) -> float:
+    return latencies[round(percent / 100 * (len(latencies) - 1))]
+
+
+def run(scenario: Scenario, threads: int, iterations: int) -> typing.Dict[str, typing.Any]:
+    """Warm the scenario up once, then run ``iterations`` calls on each of ``threads`` threads."""
+    scenario.call(scenario.prepare(0))
+    latencies: typing.List[float] = []
+    queries = [0]
+    lock = threading.Lock()
+
+    def work(offset: int) -> None:
+        counter = QueryCounter()
+        thread_latencies = []
+        with connection.execute_wrapper(counter):
+            for index in range(offset, offset + iterations):
+                argument = scenario.prepare(index)
+                counter.active = True
+                started = time.perf_counter()
+                scenario.call(argument)
+                thread_latencies.append(time.perf_counter() - started)
+                counter.active = False
+        connection.close()
+        with lock:
+            latencies.extend(thread_latencies)
+            queries[0] += counter.count
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(work, range(0, threads * iterations, iterations)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "scenario": scenario.name,
+        "cache": scenario.cache,
+        "threads": threads,
+        "calls": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed,
+        "latency_ms": dict(
+            {f"p{percent}": percentile(latencies, percent) * 1000 for percent in PERCENTILES},
+            mean=sum(latencies) / len(latencies) * 1000,
+            max=latencies[-1] * 1000,
+        ),
+        "queries_per_call": queries[0] / len(latencies),
+    }
+
+
+def get_revision() -> typing.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--agents", type=int, default=10, help="The number of API agents")
+    parser.add_argument(
+        "--permissions", type=int, default=20, help="The number of permissions of each agent"
+    )
+    parser.add_argument("--threads", default="1,4,8", help="The comma separated thread counts")
+    parser.add_argument("--iterations", type=int, default=500, help="The calls of each thread")
+    parser.add_argument("--scenario", action="append", help="Only run the named scenarios")
+    parser.add_argument("--upstream-latency", type=float, default=0, help="Milliseconds")
+    parser.add_argument("--output", help="Write the JSON results to the file, default is stdout")
+    args = parser.parse_args()
+
+    connection.creation.create_test_db(verbosity=0, serialize=False)
+    agents = set_up_agents(args.agents, max(args.permissions, 1))
+    payloads = {
+        agent.token.encode("utf-8"): json.dumps({"email": agent.email, "api": agent.api})
+        for agent in agents
+    }
+
+    def validate(
+        url: str, headers: typing.Dict[str, typing.Any], **kwargs: typing.Any
+    ) -> typing.Any:
+        if args.upstream_latency:
+            time.sleep(args.upstream_latency / 1000)
+        return UpstreamResponse(payloads[headers["authorization"]])
+
+    results = []
+    with patch("ponddy_auth.transport.Session.get", side_effect=validate):
+        for scenario in get_scenarios(agents):
+            if args.scenario and scenario.name not in args.scenario:
+                continue
+            for threads in (int(count) for count in args.threads.split(",")):
+                result = dict(
+                    run(scenario, threads, args.iterations),
+                    agents=args.agents,
+                    permissions=args.permissions,
+                )
+                results.append(result)
+                print(
+                    "{scenario:>18} {cache:>4} threads={threads:<3} {ops_per_sec:>10.1f} ops/s "
+                    "p50={p50:.3f}ms p99={p99:.3f}ms queries/call={queries_per_call:.2f}".format(
+                        **result, **result["latency_ms"]
+                    ),
+                    file=sys.stderr,
+                )
+
+    report = {
+        "meta": {
+            "revision": get_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "upstream_latency_ms": args.upstream_latency,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Load the ``core`` demo ``UserViewSet`` end to end with SSO traffic.
+
+The demo app is served by a threaded WSGI server and validates the tokens against a local
+``ValidationServer``, the ``APIClient`` requests go through real sockets on both hops. Every
+request carries a new token so each one reaches the validation server, ``--reuse-token`` loads
+the token cache of the app instead.
+
+    python benchmarks/bench_e2e.py --requests 2000 --concurrency 16 --latency 5 --output e2e.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from uuid import uuid4
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "src"), os.path.join(ROOT, "tests")]
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.contrib.auth.models import Group, Permission  # noqa: E402
+from django.core.handlers.wsgi import WSGIHandler  # noqa: E402
+from django.core.servers.basehttp import (  # noqa: E402
+    ThreadedWSGIServer,
+    WSGIRequestHandler,
+)
+from django.db import connection  # noqa: E402
+
+from ponddy_auth.authentication import get_api_agent_group_name  # noqa: E402
+from ponddy_auth.testing import ValidationServer, run_load  # noqa: E402
+from ponddy_auth.utils import APIClient  # noqa: E402
+
+SECRET = "SECRET"
+
+
+class QuietWSGIRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):  # type: ignore
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0, help="Auth server milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Auth server 500 ratio")
+    parser.add_argument(
+        "--reuse-token",
+        action="store_true",
+        help="Send one token, the app answers it from its token cache after the first request",
+    )
+    parser.add_argument("--output", help="Write the JSON result to the file, default is stdout")
+    args = parser.parse_args()
+
+    connection.creation.create_test_db(verbosity=0, serialize=False)
+    api = str(uuid4())
+    group = Group.objects.create(name=get_api_agent_group_name({"api": api}))
+    group.permissions.add(Permission.objects.get(codename="view_user"))
+
+    validation = ValidationServer(
+        {api: SECRET}, latency=args.latency / 1000, error_rate=args.error_rate
+    )
+    app = ThreadedWSGIServer(("127.0.0.1", 0), QuietWSGIRequestHandler)
+    app.set_app(WSGIHandler())
+    with validation:
+        settings.AUTH_TOKEN_VALID_URL = validation.url
+        threading.Thread(target=app.serve_forever, daemon=True).start()
+        try:
+            client = APIClient(
+                app_name="APP", api_client_id=api, api_secret=SECRET, pool_size=args.concurrency
+            )
+            host, port = app.server_address[:2]
+            result = run_load(
+                client,
+                f"http://{host}:{port}/users/",
+                args.requests,
+                args.concurrency,
+                sign_every_request=not args.reuse_token,
+            )
+        finally:
+            app.shutdown()
+            app.server_close()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "concurrency": args.concurrency,
+        "auth_server": dict(validation.stats()._asdict(), latency_ms=args.latency),
+        "result": result._asdict(),
+    }
+    print(
+        "{requests} requests {failures} failures {throughput:.1f} req/s "
+        "p50={p50:.4f}s p99={p99:.4f}s".format(**report["result"]),
+        file=sys.stderr,
+    )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
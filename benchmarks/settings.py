@@ -0,0 +1,7 @@
+from core.settings import *  # noqa: F401,F403
+
+DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}}
+
+PONDDY_AUTH_TOKEN_CACHE_MAXSIZE = 100_000
+PONDDY_AUTH_API_AGENT_CACHE_MAXSIZE = 100_000
+PONDDY_AUTH_NEGATIVE_CACHE_MAXSIZE = 100_000
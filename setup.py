@@ -1,5 +1,5 @@
 import os
-from setuptools import setup
+from setuptools import find_packages, setup
 
 
 with open("README.md", "r") as fh:
@@ -20,10 +20,13 @@ setup(
     author='lambdaTW',
     author_email='lambda@lambda.tw',
     license='MIT',
-    packages=['ponddy_auth'],
+    packages=find_packages('src', include=['ponddy_auth', 'ponddy_auth.*']),
     package_dir={'': 'src'},
     install_requires=[
         'Django', 'djangorestframework', 'python-jose', 'requests',
     ],
+    extras_require={
+        'async': ['httpx'],
+    },
     zip_safe=False
 )
@@ -49,7 +49,7 @@ class APIClientTest(TestAPIMixin, TestCase):
         super().setUp()
         self.set_up_api()
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_api_client_request_authenticated(self, mock_auth):
         from ponddy_auth.utils import APIClient
 
@@ -85,7 +85,7 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
         super().setUp()
         self.set_up_api()
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_sso_auth_will_return_user_if_auth_valid_token(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
             content=json.dumps(self.get_payload())
@@ -111,7 +111,7 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
             ]
         )
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_valid_sso_can_list_users(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
             content=json.dumps(self.get_payload())
@@ -119,7 +119,7 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
         resp = self.sso_client.get(reverse("user-list"))
         self.assertEqual(resp.status_code, 200)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_valid_sso_cannot_create_user(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
             content=json.dumps(self.get_payload())
@@ -131,19 +131,19 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
         self.assertEqual(resp.status_code, 403)
         self.assertNotEqual(resp.status_code, 200)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_invalid_sso_cannot_do_anything(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(ok=False, content=b"")
         resp = self.sso_client.get(reverse("user-list"))
         self.assertEqual(resp.status_code, 401)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_empty_authentication_token_will_not_raise_error(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwarg: MockAuthHTTPResponse(ok=False, content=b"")
         resp = self.client.get(reverse("user-list"))
         self.assertEqual(resp.status_code, 401)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_token_group_not_exists(self, mock_auth):
         payload = self.get_payload()
         payload.update({"api": str(uuid4())})
@@ -0,0 +1,337 @@
+import gc
+import threading
+import time
+import types
+import typing
+
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import AnyCache, DjangoCache, TTLCache
+
+PERM_CACHE_NAME = "_perm_cache"
+API_AGENT_PREFIX = getattr(settings, "API_AGENT_PREFIX", "api_agent")
+API_AGENT_CACHE_MAXSIZE = getattr(settings, "PONDDY_AUTH_API_AGENT_CACHE_MAXSIZE", 0)
+API_AGENT_CACHE_TTL = getattr(settings, "PONDDY_AUTH_API_AGENT_CACHE_TTL", 300)
+API_AGENT_CACHE_ALIAS = getattr(settings, "PONDDY_AUTH_API_AGENT_CACHE_ALIAS", None)
+NEGATIVE_CACHE_MAXSIZE = getattr(settings, "PONDDY_AUTH_NEGATIVE_CACHE_MAXSIZE", 0)
+NEGATIVE_CACHE_TTL = getattr(settings, "PONDDY_AUTH_NEGATIVE_CACHE_TTL", 10)
+API_AGENT_SNAPSHOT_TTL = getattr(settings, "PONDDY_AUTH_API_AGENT_SNAPSHOT_TTL", 3600)
+
+PermissionRow = typing.Tuple[int, typing.Optional[int]]
+
+
+class PermissionIndex:
+    """Give every ``Permission`` the bit of its primary key.
+
+    The grants of a group are an ``int`` whose bit ``pk`` is set for each of its permissions, they
+    stay valid in every process and across renames. The ``"app_label.codename"`` names are loaded
+    once and kept up to date by the signals, a grant of a permission the index does not know yet
+    (created by another process) reloads it, at most once per ``reload_interval`` seconds.
+    """
+
+    reload_interval = 1.0
+
+    def __init__(self) -> None:
+        self._bits: typing.Optional[typing.Dict[str, int]] = None
+        self._known = 0
+        self._masks: typing.Dict[typing.Tuple[str, ...], typing.Optional[int]] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self) -> typing.Dict[str, int]:
+        bits = {
+            "%s.%s" % (app_label, codename): pk
+            for pk, app_label, codename in Permission.objects.values_list(
+                "pk", "content_type__app_label", "codename"
+            ).order_by()
+        }
+        with self._lock:
+            self._bits = bits
+            self._known = get_grants(bits.values())
+            self._masks = {}
+            self._loaded_at = time.monotonic()
+        return bits
+
+    def reset(self) -> None:
+        with self._lock:
+            self._bits = None
+            self._masks = {}
+
+    def get_bits(self, grants: int = 0) -> typing.Dict[str, int]:
+        bits = self._bits
+        if bits is None:
+            return self.load()
+        if grants & ~self._known and time.monotonic() - self._loaded_at >= self.reload_interval:
+            return self.load()
+        return bits
+
+    def get_mask(self, perms: typing.Iterable[str], grants: int = 0) -> typing.Optional[int]:
+        """Return the grants ``perms`` need, ``None`` if one of them does not exist."""
+        key = tuple(perms)
+        if key in self._masks and not grants & ~self._known:
+            return self._masks[key]
+        bits = self.get_bits(grants)
+        mask: typing.Optional[int] = 0
+        for perm in key:
+            bit = bits.get(perm)
+            if bit is None:
+                mask = None
+                break
+            mask |= 1 << bit  # type: ignore
+        with self._lock:
+            # Every change replaces the bits, a mask of older bits is not kept
+            if self._bits is bits:
+                self._masks[key] = mask
+        return mask
+
+    def has_perms(self, grants: int, perms: typing.Iterable[str]) -> bool:
+        mask = self.get_mask(perms, grants)
+        return mask is not None and grants & mask == mask
+
+    def add(self, permission: Permission) -> None:
+        if self._bits is None:
+            return
+        app_label = ContentType.objects.get_for_id(permission.content_type_id).app_label
+        with self._lock:
+            bits = {name: pk for name, pk in self._bits.items() if pk != permission.pk}
+            bits["%s.%s" % (app_label, permission.codename)] = permission.pk
+            self._bits = bits
+            self._known |= 1 << permission.pk
+            self._masks = {}
+
+    def remove(self, pk: int) -> None:
+        if self._bits is None:
+            return
+        with self._lock:
+            self._bits = {name: bit for name, bit in self._bits.items() if bit != pk}
+            self._known &= ~(1 << pk)
+            self._masks = {}
+
+
+permission_index = PermissionIndex()
+
+
+def get_grants(permission_ids: typing.Iterable[typing.Optional[int]]) -> int:
+    grants = 0
+    for pk in permission_ids:
+        if pk is not None:
+            grants |= 1 << pk
+    return grants
+
+
+class CachedAPIAgent(typing.NamedTuple):
+    id: int
+    name: str
+    grants: int
+
+
+class APIAgentSnapshot(typing.NamedTuple):
+    agents: typing.Mapping[str, CachedAPIAgent]
+    expires_at: float
+
+
+def encode_api_agent(agent: CachedAPIAgent) -> typing.Tuple[int, str, int]:
+    return tuple(agent)  # type: ignore
+
+
+def decode_api_agent(data: typing.Tuple[int, str, int]) -> CachedAPIAgent:
+    return CachedAPIAgent(*data)
+
+
+api_agent_cache: AnyCache[CachedAPIAgent] = (
+    DjangoCache(
+        API_AGENT_CACHE_ALIAS,
+        "api_agent",
+        ttl=API_AGENT_CACHE_TTL,
+        encode=encode_api_agent,
+        decode=decode_api_agent,
+    )
+    if API_AGENT_CACHE_ALIAS
+    else TTLCache(maxsize=API_AGENT_CACHE_MAXSIZE, ttl=API_AGENT_CACHE_TTL)
+)
+unknown_api_agent_cache: TTLCache[bool] = TTLCache(
+    maxsize=NEGATIVE_CACHE_MAXSIZE, ttl=NEGATIVE_CACHE_TTL
+)
+api_agent_snapshot = APIAgentSnapshot(agents=types.MappingProxyType({}), expires_at=0.0)
+
+
+def get_group_grants(group: Group) -> int:
+    return get_grants(group.permissions.all().values_list("pk", flat=True).order_by())
+
+
+def get_api_agent_rows(name: str) -> "QuerySet[Group, PermissionRow]":
+    return Group.objects.filter(name=name).values_list("id", "permissions__id").order_by()
+
+
+def build_cached_api_agent(name: str, rows: typing.Iterable[PermissionRow]) -> CachedAPIAgent:
+    rows = list(rows)
+    if not rows:
+        raise Group.DoesNotExist(f"Group {name} does not exist")
+    return CachedAPIAgent(id=rows[0][0], name=name, grants=get_grants(pk for _, pk in rows))
+
+
+def build_api_agent(agent: CachedAPIAgent) -> Group:
+    """Build a fresh ``Group`` whose permissions are already loaded, it runs no query."""
+    group = Group.from_db(None, ["id", "name"], [agent.id, agent.name])
+    setattr(group, PERM_CACHE_NAME, agent.grants)
+    return group
+
+
+def preload_api_agents(
+    ttl: float = API_AGENT_SNAPSHOT_TTL, freeze: bool = False
+) -> typing.Mapping[str, CachedAPIAgent]:
+    """Load every API agent group into the read-only snapshot of the process with one query.
+
+    Call it before the server forks, the workers share the snapshot copy-on-write until ``ttl``
+    seconds pass, the agents created later are resolved as usual. ``freeze`` prepares the fork:
+    it closes the database connections, which the workers must not share, and moves every object
+    alive to the permanent generation of ``gc`` so that the collections of the workers do not
+    touch, and copy, their pages.
+    """
+    global api_agent_snapshot
+    rows: typing.Dict[str, typing.List[PermissionRow]] = {}
+    for group_id, name, permission_id in (
+        Group.objects.filter(name__startswith=f"{API_AGENT_PREFIX}_")
+        .values_list("id", "name", "permissions__id")
+        .order_by()
+    ):
+        rows.setdefault(name, []).append((group_id, permission_id))
+    permission_index.load()
+    agents = types.MappingProxyType(
+        {name: build_cached_api_agent(name, group_rows) for name, group_rows in rows.items()}
+    )
+    api_agent_snapshot = APIAgentSnapshot(agents=agents, expires_at=time.monotonic() + ttl)
+    if freeze:
+        connections.close_all()
+        if hasattr(gc, "freeze"):
+            gc.collect()
+            gc.freeze()
+    return agents
+
+
+def drop_preloaded_api_agents(predicate: typing.Callable[[CachedAPIAgent], bool]) -> None:
+    global api_agent_snapshot
+    agents = api_agent_snapshot.agents
+    if any(predicate(agent) for agent in agents.values()):
+        api_agent_snapshot = api_agent_snapshot._replace(
+            agents=types.MappingProxyType(
+                {name: agent for name, agent in agents.items() if not predicate(agent)}
+            )
+        )
+
+
+def get_cached_api_agent(name: str) -> typing.Optional[CachedAPIAgent]:
+    snapshot = api_agent_snapshot
+    agent = snapshot.agents.get(name)
+    if agent is not None and snapshot.expires_at > time.monotonic():
+        return agent
+    return api_agent_cache.get(name)
+
+
+def resolve_api_agent(name: str) -> Group:
+    """Resolve the API agent group and its permissions, raise ``Group.DoesNotExist`` if missing."""
+    agent = get_cached_api_agent(name)
+    if agent is None:
+        if unknown_api_agent_cache.get(name) is not None:
+            raise Group.DoesNotExist(f"Group {name} does not exist")
+        try:
+            agent = build_cached_api_agent(name, get_api_agent_rows(name))
+        except Group.DoesNotExist:
+            unknown_api_agent_cache.set(name, True)
+            raise
+        api_agent_cache.set(name, agent)
+    return build_api_agent(agent)
+
+
+def resolve_api_agents(names: typing.Iterable[str]) -> typing.Dict[str, Group]:
+    """Resolve many API agent groups with one query, the missing names are left out."""
+    agents: typing.Dict[str, CachedAPIAgent] = {}
+    missing = []
+    for name in set(names):
+        agent = get_cached_api_agent(name)
+        if agent is not None:
+            agents[name] = agent
+        elif unknown_api_agent_cache.get(name) is None:
+            missing.append(name)
+    if missing:
+        rows: typing.Dict[str, typing.List[PermissionRow]] = {name: [] for name in missing}
+        for group_id, name, permission_id in (
+            Group.objects.filter(name__in=missing)
+            .values_list("id", "name", "permissions__id")
+            .order_by()
+        ):
+            rows[name].append((group_id, permission_id))
+        for name, group_rows in rows.items():
+            if not group_rows:
+                unknown_api_agent_cache.set(name, True)
+                continue
+            agents[name] = build_cached_api_agent(name, group_rows)
+            api_agent_cache.set(name, agents[name])
+    return {name: build_api_agent(agent) for name, agent in agents.items()}
+
+
+def invalidate_api_agents(group_ids: typing.Optional[typing.Iterable[int]] = None) -> None:
+    if group_ids is None:
+        api_agent_cache.clear()
+        drop_preloaded_api_agents(lambda agent: True)
+        return
+    group_ids = set(group_ids)
+    api_agent_cache.delete_where(lambda agent: agent.id in group_ids)
+    drop_preloaded_api_agents(lambda agent: agent.id in group_ids)
+
+
+@receiver(post_save, sender=Group, dispatch_uid="ponddy_auth_group_saved")
+@receiver(post_delete, sender=Group, dispatch_uid="ponddy_auth_group_deleted")
+def on_group_changed(sender: typing.Any, instance: Group, **kwargs: typing.Any) -> None:
+    api_agent_cache.delete(instance.name)
+    unknown_api_agent_cache.delete(instance.name)
+    invalidate_api_agents([instance.pk])
+
+
+@receiver(post_save, sender=Permission, dispatch_uid="ponddy_auth_permission_saved")
+def on_permission_saved(sender: typing.Any, instance: Permission, **kwargs: typing.Any) -> None:
+    # The grants are bits of the primary keys, a renamed permission only moves in the index
+    permission_index.add(instance)
+
+
+@receiver(post_delete, sender=Permission, dispatch_uid="ponddy_auth_permission_deleted")
+def on_permission_deleted(sender: typing.Any, instance: Permission, **kwargs: typing.Any) -> None:
+    permission_index.remove(instance.pk)
+    # The database may hand the primary key to the next permission
+    bit = 1 << instance.pk
+    api_agent_cache.delete_where(lambda agent: bool(agent.grants & bit))
+    drop_preloaded_api_agents(lambda agent: bool(agent.grants & bit))
+
+
+@receiver(post_save, sender=ContentType, dispatch_uid="ponddy_auth_content_type_saved")
+@receiver(post_delete, sender=ContentType, dispatch_uid="ponddy_auth_content_type_deleted")
+def on_content_type_changed(sender: typing.Any, **kwargs: typing.Any) -> None:
+    permission_index.reset()
+
+
+@receiver(
+    m2m_changed, sender=Group.permissions.through, dispatch_uid="ponddy_auth_group_permissions"
+)
+def on_group_permissions_changed(
+    sender: typing.Any,
+    instance: typing.Union[Group, Permission],
+    action: str,
+    reverse: bool,
+    pk_set: typing.Optional[typing.Set[int]],
+    **kwargs: typing.Any,
+) -> None:
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        invalidate_api_agents([instance.pk])
+    elif pk_set is not None:
+        invalidate_api_agents(pk_set)
+    else:
+        # ``permission.group_set.clear()`` does not tell which groups lost the permission
+        invalidate_api_agents()
@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import time
+import typing
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db.models import QuerySet
+from rest_framework.authentication import get_authorization_header
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+
+from .agents import (
+    api_agent_cache,
+    build_api_agent,
+    build_cached_api_agent,
+    get_api_agent_rows,
+    get_cached_api_agent,
+    unknown_api_agent_cache,
+)
+from .authentication import (
+    API_AGENT_PROPERTY_NAME,
+    AuthServerError,
+    AuthServerUnavailable,
+    InvalidToken,
+    MissingAPIAgent,
+    Payload,
+    SSOAuthentication,
+    User,
+    UserType,
+    ValidationHeaders,
+    attach_permission_functions,
+    get_api_agent_group_name,
+    get_token_fingerprint,
+    record_authentication,
+)
+from .cache import DjangoCache
+from .metrics import record_phase
+from .transport import VALIDATION_CONNECT_TIMEOUT, VALIDATION_READ_TIMEOUT
+from .utils import APIHeaderMixin
+
+httpx: typing.Any
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+logger = logging.getLogger(__file__)
+T = typing.TypeVar("T")
+ASYNC_VALIDATION_POOL_SIZE = getattr(settings, "PONDDY_AUTH_ASYNC_VALIDATION_POOL_SIZE", 100)
+ASYNC_CLIENT_MAX_CONNECTIONS = getattr(settings, "PONDDY_AUTH_ASYNC_CLIENT_MAX_CONNECTIONS", 100)
+ASYNC_CLIENT_MAX_CONNECTIONS_PER_HOST = getattr(
+    settings, "PONDDY_AUTH_ASYNC_CLIENT_MAX_CONNECTIONS_PER_HOST", 20
+)
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, typing.Any]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_validation_client() -> "httpx.AsyncClient":
+    """Return the keep-alive client of the running event loop used to reach the auth server."""
+    if httpx is None:  # pragma: no cover
+        raise ImproperlyConfigured("Install httpx to use the asyncio authentication")
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_VALIDATION_POOL_SIZE,
+                max_keepalive_connections=ASYNC_VALIDATION_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(VALIDATION_READ_TIMEOUT, connect=VALIDATION_CONNECT_TIMEOUT),
+        )
+        _clients[loop] = client
+    return client
+
+
+async def afirst(queryset: "QuerySet[typing.Any]") -> typing.Any:
+    if hasattr(queryset, "afirst"):
+        return await queryset.afirst()
+    return await sync_to_async(queryset.first)()  # pragma: no cover
+
+
+async def aget_or_create(queryset: "QuerySet[typing.Any]", **kwargs: typing.Any) -> typing.Any:
+    if hasattr(queryset, "aget_or_create"):
+        return await queryset.aget_or_create(**kwargs)
+    return await sync_to_async(queryset.get_or_create)(**kwargs)  # pragma: no cover
+
+
+async def acall_cache(
+    cache: typing.Any,
+    function: typing.Callable[..., T],
+    *args: typing.Any,
+) -> T:
+    """Run ``function`` off the event loop when it reaches the shared ``cache``."""
+    if isinstance(cache, DjangoCache):
+        return await sync_to_async(function)(*args)
+    return function(*args)
+
+
+async def alist(queryset: "QuerySet[typing.Any]") -> typing.List[typing.Any]:
+    if hasattr(queryset, "__aiter__"):
+        return [item async for item in queryset]
+    return await sync_to_async(lambda: list(queryset))()  # pragma: no cover
+
+
+class AsyncSSOAuthentication(SSOAuthentication):
+    """``SSOAuthentication`` with a non-blocking ``aauthenticate`` for ASGI deployments.
+
+    ``authenticate`` keeps working synchronously, so the class can stay in
+    ``DEFAULT_AUTHENTICATION_CLASSES`` while async views await ``aauthenticate``.
+    """
+
+    async def arequest_validation(self, headers: ValidationHeaders) -> Payload:
+        client = get_async_validation_client()
+        self.check_validation_circuit()
+        try:
+            check_token = await client.get(
+                settings.AUTH_TOKEN_VALID_URL,
+                headers={key: value for key, value in headers.items() if value is not None},
+            )
+        except Exception as e:
+            raise self.get_validation_exception(e, isinstance(e, httpx.TimeoutException))
+        return self.parse_validation_response(
+            check_token.is_success, check_token.status_code, check_token.text
+        )
+
+    async def avalidate_token(self, headers: ValidationHeaders) -> Payload:
+        payload = self.verify_locally(headers)
+        if payload is not None:
+            return payload
+        key = get_token_fingerprint(headers)
+        cache = self.token_cache
+        payload = await acall_cache(cache, self.get_cached_payload, key, headers)
+        if payload is None:
+            try:
+                payload = await self.arequest_validation(headers)
+            except InvalidToken:
+                await acall_cache(cache, cache.delete, key)
+                self.rejected_token_cache.set(key, True)
+                raise
+            except (AuthServerError, AuthServerUnavailable) as e:
+                payload = await acall_cache(cache, self.get_stale_payload, key, e)
+            else:
+                await acall_cache(cache, self.cache_validation, key, payload)
+        return dict(payload)
+
+    async def aget_user(self, payload: Payload) -> typing.Optional[UserType]:
+        user: typing.Optional[UserType] = AnonymousUser()
+        if payload.get("email", False):
+            user = await afirst(User.objects.filter(email=payload["email"]))
+            if not user:
+                user, _ = await aget_or_create(
+                    User.objects.all(), username=payload["email"], email=payload["email"]
+                )
+        return user
+
+    async def aget_api_agent(self, payload: Payload) -> Group:
+        name = get_api_agent_group_name(payload)
+        agent = await acall_cache(api_agent_cache, get_cached_api_agent, name)
+        if agent is None:
+            if unknown_api_agent_cache.get(name) is not None:
+                raise MissingAPIAgent("Group not exists")
+            try:
+                agent = build_cached_api_agent(name, await alist(get_api_agent_rows(name)))
+            except ObjectDoesNotExist:
+                unknown_api_agent_cache.set(name, True)
+                raise MissingAPIAgent("Group not exists")
+            await acall_cache(api_agent_cache, api_agent_cache.set, name, agent)
+        api_agent = build_api_agent(agent)
+        attach_permission_functions(api_agent)
+        return api_agent
+
+    async def aauthenticate(
+        self, request: Request
+    ) -> typing.Optional[typing.Tuple[typing.Optional[UserType], typing.Any]]:
+        started = time.perf_counter()
+        token: bytes = get_authorization_header(request)
+        if not token or token and token.split()[0] not in (b"SSO", "SSO"):
+            return (None, None)
+
+        headers = self.get_validation_headers(request, token)
+        started = record_phase("header_parsing", started)
+        try:
+            payload = await self.avalidate_token(headers)
+            started = record_phase("upstream_validation", started)
+            user = await self.aget_user(payload)
+            started = record_phase("user_lookup", started)
+            api_agent = await self.aget_api_agent(payload)
+            record_phase("group_resolution", started)
+        except APIException as e:
+            record_authentication(e)
+            raise
+        record_authentication()
+        setattr(user, API_AGENT_PROPERTY_NAME, api_agent)
+        return (user, payload)
+
+
+class AsyncAPIClient(APIHeaderMixin):
+    """The asyncio counterpart of ``APIClient``, it sends the same SSO header and JWT payload.
+
+    It owns an ``httpx.AsyncClient`` pool of ``max_connections`` connections and lets at most
+    ``max_connections_per_host`` requests run concurrently against each host.
+    """
+
+    def __init__(
+        self,
+        payload_patch: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        app_name: typing.Optional[str] = None,
+        api_client_id: typing.Optional[str] = None,
+        api_secret: typing.Optional[str] = None,
+        api_token_prefix: typing.Optional[str] = None,
+        api_key_id: typing.Optional[str] = None,
+        api_token_lifetime: typing.Optional[float] = None,
+        api_token_refresh_margin: typing.Optional[float] = None,
+        max_connections: int = ASYNC_CLIENT_MAX_CONNECTIONS,
+        max_connections_per_host: int = ASYNC_CLIENT_MAX_CONNECTIONS_PER_HOST,
+        **kwargs: typing.Any,
+    ):
+        if httpx is None:  # pragma: no cover
+            raise ImproperlyConfigured("Install httpx to use the AsyncAPIClient")
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections
+            ),
+            **kwargs,
+        )
+        # The signed header goes straight into the headers of the httpx client
+        self.headers = self.client.headers
+        self.max_connections_per_host = max_connections_per_host
+        self._host_semaphores: typing.Dict[str, asyncio.Semaphore] = {}
+        self.set_up_api_credentials(
+            payload_patch=payload_patch,
+            app_name=app_name,
+            api_client_id=api_client_id,
+            api_secret=api_secret,
+            api_token_prefix=api_token_prefix,
+            api_key_id=api_key_id,
+            api_token_lifetime=api_token_lifetime,
+            api_token_refresh_margin=api_token_refresh_margin,
+        )
+
+    def get_host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = httpx.URL(url).host
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._host_semaphores[host] = asyncio.Semaphore(
+                self.max_connections_per_host
+            )
+        return semaphore
+
+    async def request(self, method: str, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        if self.api_header_expiring():
+            self.refresh_api_header()
+        async with self.get_host_semaphore(url):
+            return await self.client.request(method, url, **kwargs)
+
+    async def get(self, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        return await self.request("GET", url, **kwargs)
+
+    async def options(self, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        return await self.request("OPTIONS", url, **kwargs)
+
+    async def head(self, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        return await self.request("HEAD", url, **kwargs)
+
+    async def post(self, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        return await self.request("PUT", url, **kwargs)
+
+    async def patch(self, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        return await self.request("PATCH", url, **kwargs)
+
+    async def delete(self, url: str, **kwargs: typing.Any) -> "httpx.Response":
+        return await self.request("DELETE", url, **kwargs)
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self) -> "AsyncAPIClient":
+        return self
+
+    async def __aexit__(self, *args: typing.Any) -> None:
+        await self.aclose()
@@ -1,5 +1,26 @@
+import logging
+import os
+
 from django.apps import AppConfig
+from django.db import DatabaseError
+
+logger = logging.getLogger(__file__)
+
+# Set in the environment of the server process only, so the management commands, ``test``
+# included, never query the database before they are ready to
+PRELOAD_API_AGENTS_ENV = "PONDDY_AUTH_PRELOAD_API_AGENTS"
 
 
 class PonddyAuthConfig(AppConfig):
     name = "ponddy_auth"
+
+    def ready(self) -> None:
+        from . import agents
+
+        if os.environ.get(PRELOAD_API_AGENTS_ENV) != "1":
+            return
+        try:
+            agents.preload_api_agents(freeze=True)
+        except DatabaseError as e:
+            # e.g. ``migrate`` runs before the auth tables exist
+            logger.warning("Cannot preload the API agents: %s", e)
@@ -1,5 +1,7 @@
+import hashlib
 import json
 import logging
+import time
 import typing
 from functools import partial
 from uuid import UUID
@@ -9,36 +11,116 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser, AnonymousUser, Group
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.functional import SimpleLazyObject
+from rest_framework import status
 from rest_framework.authentication import get_authorization_header
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.exceptions import APIException, AuthenticationFailed
 from rest_framework.request import Request
 
+from .agents import (
+    API_AGENT_PREFIX,
+    NEGATIVE_CACHE_MAXSIZE,
+    NEGATIVE_CACHE_TTL,
+    PERM_CACHE_NAME,
+    get_group_grants,
+    permission_index,
+    resolve_api_agent,
+)
+from .breaker import CircuitBreaker
+from .cache import AnyCache, DjangoCache, TTLCache
+from .concurrency import Refresher, SingleFlight
+from .log import log_event, log_validation
+from .metrics import (
+    AUTHENTICATIONS,
+    OUTCOME_INVALID_TOKEN,
+    OUTCOME_MISSING_GROUP,
+    OUTCOME_SUCCESS,
+    OUTCOME_UPSTREAM_ERROR,
+    get_metrics_exporter,
+    record_phase,
+)
+from .transport import (
+    VALIDATION_CONNECT_TIMEOUT,
+    VALIDATION_READ_TIMEOUT,
+    get_validation_session,
+    get_validation_timeout,
+)
+from .verification import (
+    VERIFICATION_MODE,
+    VERIFICATION_MODE_LOCAL,
+    VERIFICATION_MODE_REMOTE,
+    UnverifiableToken,
+    verify_token,
+)
+
 UserType = typing.Union[AbstractUser, AnonymousUser]
+Payload = typing.Dict[str, typing.Any]
+ValidationHeaders = typing.Dict[str, typing.Any]
 logger = logging.getLogger(__file__)
 User = get_user_model()
 API_AGENT_GROUP_NAME_FORMAT = "{prefix}_{api_agent}"
-API_AGENT_PREFIX = getattr(settings, "API_AGENT_PREFIX", "api_agent")
 API_AGENT_PROPERTY_NAME = getattr(settings, "API_AGENT_PROPERTY_NAME", "_api_agent")
+TOKEN_CACHE_MAXSIZE = getattr(settings, "PONDDY_AUTH_TOKEN_CACHE_MAXSIZE", 0)
+TOKEN_CACHE_TTL = getattr(settings, "PONDDY_AUTH_TOKEN_CACHE_TTL", 60)
+TOKEN_CACHE_ALIAS = getattr(settings, "PONDDY_AUTH_TOKEN_CACHE_ALIAS", None)
+VALIDATION_TIMEOUT_STATUS = getattr(settings, "PONDDY_AUTH_VALIDATION_TIMEOUT_STATUS", 401)
+STALE_IF_ERROR = getattr(settings, "PONDDY_AUTH_STALE_IF_ERROR", 0)
+CIRCUIT_BREAKER = getattr(settings, "PONDDY_AUTH_CIRCUIT_BREAKER", False)
+CIRCUIT_BREAKER_FAILURE_RATE = getattr(settings, "PONDDY_AUTH_CIRCUIT_BREAKER_FAILURE_RATE", 0.5)
+CIRCUIT_BREAKER_MINIMUM_CALLS = getattr(settings, "PONDDY_AUTH_CIRCUIT_BREAKER_MINIMUM_CALLS", 10)
+CIRCUIT_BREAKER_WINDOW_SIZE = getattr(settings, "PONDDY_AUTH_CIRCUIT_BREAKER_WINDOW_SIZE", 50)
+CIRCUIT_BREAKER_OPEN_DURATION = getattr(settings, "PONDDY_AUTH_CIRCUIT_BREAKER_OPEN_DURATION", 30)
+CIRCUIT_BREAKER_HALF_OPEN_CALLS = getattr(
+    settings, "PONDDY_AUTH_CIRCUIT_BREAKER_HALF_OPEN_CALLS", 1
+)
+LAZY_USER = getattr(settings, "PONDDY_AUTH_LAZY_USER", False)
+REFRESH_AHEAD = getattr(settings, "PONDDY_AUTH_REFRESH_AHEAD", 0)
+REFRESH_AHEAD_WORKERS = getattr(settings, "PONDDY_AUTH_REFRESH_AHEAD_WORKERS", 2)
+SINGLE_FLIGHT = getattr(settings, "PONDDY_AUTH_SINGLE_FLIGHT", True)
+SINGLE_FLIGHT_TIMEOUT = getattr(
+    settings,
+    "PONDDY_AUTH_SINGLE_FLIGHT_TIMEOUT",
+    VALIDATION_CONNECT_TIMEOUT + VALIDATION_READ_TIMEOUT,
+)
+
+# Only these answers reject the token itself, they are the ones kept in the negative cache
+TOKEN_REJECTIONS = frozenset([status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN])
+RETRYABLE_CLIENT_ERRORS = frozenset(
+    [status.HTTP_408_REQUEST_TIMEOUT, status.HTTP_429_TOO_MANY_REQUESTS]
+)
+
+
+class AuthServerUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Auth server is unavailable."
+    default_code = "auth_server_unavailable"
+
+
+class AuthServerError(AuthenticationFailed):
+    """The auth server failed to answer, the token may still be valid."""
+
+
+class InvalidToken(AuthenticationFailed):
+    """The auth server rejected the token, unlike its failures this result can be cached."""
+
+
+class MissingAPIAgent(AuthenticationFailed):
+    """The token is valid but its API agent group does not exist."""
+
+
+def get_group_cached_grants(group: Group) -> int:
+    if not hasattr(group, PERM_CACHE_NAME):
+        setattr(group, PERM_CACHE_NAME, get_group_grants(group))
+    grants: int = getattr(group, PERM_CACHE_NAME)
+    return grants
 
 
 def has_perm(self: Group, perm: str) -> bool:
-    perm_cache_name = "_perm_cache"
-    if not hasattr(self, perm_cache_name):
-        setattr(
-            self,
-            perm_cache_name,
-            {
-                "%s.%s" % (ct, name)
-                for ct, name in self.permissions.all()
-                .values_list("content_type__app_label", "codename")
-                .order_by()
-            },
-        )
-    return perm in getattr(self, perm_cache_name)
+    return permission_index.has_perms(get_group_cached_grants(self), (perm,))
 
 
-def has_perms(self: UserType, perm_list: typing.List[str]) -> bool:
-    return all(self.has_perm(perm) for perm in perm_list)
+def has_perms(self: Group, perm_list: typing.List[str]) -> bool:
+    return permission_index.has_perms(get_group_cached_grants(self), perm_list)
 
 
 def attach_permission_functions(obj: Group) -> None:
@@ -47,53 +129,329 @@ def attach_permission_functions(obj: Group) -> None:
         setattr(obj, function.__name__, partial(function, obj))  # type: ignore
 
 
+def get_token_fingerprint(headers: ValidationHeaders) -> str:
+    digest = hashlib.sha256()
+    for name in ("authorization", "app", "api", "status"):
+        value = headers.get(name)
+        if not isinstance(value, bytes):
+            value = str(value).encode("utf-8")
+        digest.update(value)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_api_agent_group_name(payload: Payload) -> str:
+    try:
+        return API_AGENT_GROUP_NAME_FORMAT.format(
+            prefix=API_AGENT_PREFIX, api_agent=str(UUID(payload["api"]))
+        )
+    except ValueError:
+        raise MissingAPIAgent("Group not exists")
+    except KeyError:
+        raise AuthenticationFailed("Cannot found API info in the payload")
+
+
+def get_upstream_error(detail: str) -> APIException:
+    if VALIDATION_TIMEOUT_STATUS == status.HTTP_503_SERVICE_UNAVAILABLE:
+        return AuthServerUnavailable(detail)
+    return AuthServerError(detail)
+
+
+def is_upstream_error(status_code: typing.Any) -> bool:
+    # A timed out or throttled validation says nothing about the token
+    return isinstance(status_code, int) and (
+        status.is_server_error(status_code) or status_code in RETRYABLE_CLIENT_ERRORS
+    )
+
+
+def is_token_rejection(status_code: typing.Any) -> bool:
+    return status_code in TOKEN_REJECTIONS
+
+
+def get_authentication_outcome(error: typing.Optional[APIException]) -> str:
+    if error is None:
+        return OUTCOME_SUCCESS
+    if isinstance(error, MissingAPIAgent):
+        return OUTCOME_MISSING_GROUP
+    if isinstance(error, (AuthServerError, AuthServerUnavailable)):
+        return OUTCOME_UPSTREAM_ERROR
+    return OUTCOME_INVALID_TOKEN
+
+
+def record_authentication(error: typing.Optional[APIException] = None) -> None:
+    get_metrics_exporter().increment(
+        AUTHENTICATIONS, {"outcome": get_authentication_outcome(error)}
+    )
+
+
+def get_payload_ttl(payload: Payload) -> typing.Optional[float]:
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        return float(exp) - time.time()
+    return None
+
+
+if typing.TYPE_CHECKING:
+    # Generic in django-stubs only, ``SimpleLazyObject`` cannot be subscripted at runtime
+    LazyObjectBase = SimpleLazyObject[typing.Any]
+else:
+    LazyObjectBase = SimpleLazyObject
+
+
+class LazyAPIAgent(LazyObjectBase):
+    # ``LazyObject.__getattribute__`` looks ``_mask_wrapped`` up on the attributes it returns,
+    # answering it here keeps ``LazyUser`` from resolving the agent it hands out.
+    _mask_wrapped = True
+
+
+class LazyUser(LazyObjectBase):
+    """The user of the payload, looked up on first use.
+
+    ``is_authenticated``, ``is_anonymous`` and ``bool`` are answered from the payload, the API
+    agent attribute is another lazy object resolved on first use, so neither runs a query
+    before it is needed.
+    """
+
+    def __init__(self, authentication: "SSOAuthentication", payload: Payload):
+        api_agent = LazyAPIAgent(partial(authentication.get_api_agent, payload))
+
+        def get_user() -> typing.Optional[UserType]:
+            user = authentication.get_user(payload)
+            setattr(user, API_AGENT_PROPERTY_NAME, api_agent)
+            return user
+
+        super().__init__(get_user)
+        self.__dict__["_payload"] = payload
+        self.__dict__[API_AGENT_PROPERTY_NAME] = api_agent
+
+    @property
+    def is_authenticated(self) -> bool:
+        return bool(self._payload.get("email", False))
+
+    @property
+    def is_anonymous(self) -> bool:
+        return not self.is_authenticated
+
+    def __bool__(self) -> bool:
+        return True
+
+
 class SSOAuthentication:
+    token_cache: AnyCache[Payload] = (
+        DjangoCache(
+            TOKEN_CACHE_ALIAS,
+            "token",
+            ttl=TOKEN_CACHE_TTL,
+            encode=partial(json.dumps, separators=(",", ":")),
+            decode=json.loads,
+        )
+        if TOKEN_CACHE_ALIAS
+        else TTLCache(maxsize=TOKEN_CACHE_MAXSIZE, ttl=TOKEN_CACHE_TTL)
+    )
+    rejected_token_cache: TTLCache[bool] = TTLCache(
+        maxsize=NEGATIVE_CACHE_MAXSIZE, ttl=NEGATIVE_CACHE_TTL
+    )
+    verification_mode: str = VERIFICATION_MODE
+    lazy_user: bool = LAZY_USER
+    validation_breaker: typing.Optional[CircuitBreaker] = (
+        CircuitBreaker(
+            failure_rate_threshold=CIRCUIT_BREAKER_FAILURE_RATE,
+            minimum_calls=CIRCUIT_BREAKER_MINIMUM_CALLS,
+            window_size=CIRCUIT_BREAKER_WINDOW_SIZE,
+            open_duration=CIRCUIT_BREAKER_OPEN_DURATION,
+            half_open_calls=CIRCUIT_BREAKER_HALF_OPEN_CALLS,
+        )
+        if CIRCUIT_BREAKER
+        else None
+    )
+    validation_flight: typing.Optional[SingleFlight[Payload]] = (
+        SingleFlight(timeout=SINGLE_FLIGHT_TIMEOUT) if SINGLE_FLIGHT else None
+    )
+    refresh_ahead: float = REFRESH_AHEAD
+    validation_refresher: typing.Optional[Refresher] = (
+        Refresher(max_workers=REFRESH_AHEAD_WORKERS) if REFRESH_AHEAD else None
+    )
+
+    def get_validation_headers(self, request: Request, token: bytes) -> ValidationHeaders:
+        return {
+            "authorization": token,
+            "app": request.META.get("HTTP_APP", None),
+            "api": request.META.get("HTTP_API", None),
+            "status": str(request.META.get("HTTP_STATUS", None)),
+        }
+
+    def check_validation_circuit(self) -> None:
+        if self.validation_breaker is not None and not self.validation_breaker.allow_request():
+            raise get_upstream_error("Auth server circuit is open")
+
+    def record_validation_outcome(self, success: bool) -> None:
+        if self.validation_breaker is None:
+            return
+        if success:
+            self.validation_breaker.record_success()
+        else:
+            self.validation_breaker.record_failure()
+
+    def get_validation_exception(self, error: Exception, timeout: bool) -> APIException:
+        self.record_validation_outcome(False)
+        if timeout:
+            log_event(logging.WARNING, "validation", outcome="timeout", error=error)
+            return get_upstream_error("Auth server timeout")
+        log_event(logging.INFO, "validation", outcome="request_error", error=error)
+        return AuthServerError()
+
+    def parse_validation_response(self, ok: bool, status_code: typing.Any, text: str) -> Payload:
+        upstream_error = is_upstream_error(status_code)
+        log_validation(ok, status_code, text, upstream_error)
+        self.record_validation_outcome(not upstream_error)
+        if ok:
+            payload: Payload = json.loads(text)
+            return payload
+        if upstream_error:
+            raise AuthServerError()
+        if is_token_rejection(status_code):
+            raise InvalidToken()
+        raise AuthenticationFailed()
+
+    def request_validation(self, headers: ValidationHeaders) -> Payload:
+        self.check_validation_circuit()
+        try:
+            check_token = get_validation_session().get(
+                settings.AUTH_TOKEN_VALID_URL, headers=headers, timeout=get_validation_timeout()
+            )
+        except Exception as e:
+            raise self.get_validation_exception(e, isinstance(e, requests.Timeout))
+        return self.parse_validation_response(
+            check_token.ok, check_token.status_code, check_token.text
+        )
+
+    def get_cached_payload(
+        self, key: str, headers: typing.Optional[ValidationHeaders] = None
+    ) -> typing.Optional[Payload]:
+        """Return the cached validation, refresh it in the background if it expires soon.
+
+        Only a cached result that is read within ``refresh_ahead`` seconds of its expiry is
+        refreshed, the cold ones just expire.
+        """
+        if self.rejected_token_cache.get(key) is not None:
+            raise InvalidToken()
+        payload, ttl = self.token_cache.get_with_ttl(key)
+        if payload is not None and headers is not None and ttl <= self.refresh_ahead:
+            self.refresh_validation(key, headers, payload, ttl)
+        return payload
+
+    def refresh_validation(
+        self, key: str, headers: ValidationHeaders, payload: Payload, ttl: float
+    ) -> None:
+        if self.validation_refresher is None:
+            return
+        token_ttl = get_payload_ttl(payload)
+        if token_ttl is not None and token_ttl <= ttl:
+            # The token expires with the cached result, a new validation would not outlive it
+            return
+        self.validation_refresher.submit(key, partial(self.fetch_validation, key, dict(headers)))
+
+    def cache_validation(self, key: str, payload: Payload) -> None:
+        ttl = get_payload_ttl(payload)
+        stale_ttl = self.token_cache.ttl + STALE_IF_ERROR if STALE_IF_ERROR else 0
+        if ttl is not None:
+            # A stale copy is never served after the token expired
+            stale_ttl = min(stale_ttl, ttl)
+        self.token_cache.set(key, payload, ttl=ttl, stale_ttl=stale_ttl)
+
+    def get_stale_payload(self, key: str, error: APIException) -> Payload:
+        payload = self.token_cache.get_stale(key)
+        if payload is None:
+            raise error
+        logger.warning("Serve the stale validation result, %s", error)
+        return payload
+
+    def request_and_cache_validation(self, key: str, headers: ValidationHeaders) -> Payload:
+        try:
+            payload = self.request_validation(headers)
+        except InvalidToken:
+            # A token revoked while its result is refreshed ahead stops at once
+            self.token_cache.delete(key)
+            self.rejected_token_cache.set(key, True)
+            raise
+        except (AuthServerError, AuthServerUnavailable) as e:
+            return self.get_stale_payload(key, e)
+        self.cache_validation(key, payload)
+        return payload
+
+    def verify_locally(self, headers: ValidationHeaders) -> typing.Optional[Payload]:
+        if self.verification_mode == VERIFICATION_MODE_REMOTE:
+            return None
+        try:
+            return verify_token(headers)
+        except UnverifiableToken:
+            if self.verification_mode == VERIFICATION_MODE_LOCAL:
+                raise
+        return None
+
+    def fetch_validation(self, key: str, headers: ValidationHeaders) -> Payload:
+        if self.validation_flight is None:
+            return self.request_and_cache_validation(key, headers)
+        return self.validation_flight.do(
+            key, partial(self.request_and_cache_validation, key, headers)
+        )
+
+    def validate_token(self, headers: ValidationHeaders) -> Payload:
+        payload = self.verify_locally(headers)
+        if payload is not None:
+            return payload
+        key = get_token_fingerprint(headers)
+        payload = self.get_cached_payload(key, headers)
+        if payload is None:
+            payload = self.fetch_validation(key, headers)
+        return dict(payload)
+
+    def get_user(self, payload: Payload) -> typing.Optional[UserType]:
+        user: typing.Optional[UserType] = AnonymousUser()
+        if payload.get("email", False):
+            user = User.objects.filter(email=payload["email"]).first()
+            if not user:
+                user, _ = User.objects.get_or_create(
+                    username=payload["email"], email=payload["email"]
+                )
+        return user
+
+    def get_api_agent(self, payload: Payload) -> Group:
+        try:
+            api_agent = resolve_api_agent(get_api_agent_group_name(payload))
+        except ObjectDoesNotExist:
+            raise MissingAPIAgent("Group not exists")
+        attach_permission_functions(api_agent)
+        return api_agent
+
     def authenticate(
         self, request: Request
     ) -> typing.Optional[typing.Tuple[typing.Optional[UserType], typing.Any]]:
+        started = time.perf_counter()
         token: bytes = get_authorization_header(request)
         if not token or token and token.split()[0] not in (b"SSO", "SSO"):
             return (None, None)
 
-        check_token = None
+        headers = self.get_validation_headers(request, token)
+        started = record_phase("header_parsing", started)
         try:
-            check_token = requests.get(
-                settings.AUTH_TOKEN_VALID_URL,
-                headers={
-                    "authorization": token,
-                    "app": request.META.get("HTTP_APP", None),
-                    "api": request.META.get("HTTP_API", None),
-                    "status": str(request.META.get("HTTP_STATUS", None)),
-                },
-            )
-        except Exception as e:
-            logger.info(str(e))
-        else:
-            logger.info(f"{check_token.status_code} {check_token.text}")
-
-        if check_token and check_token.ok:
-            payload = json.loads(check_token.text)
-            user: typing.Optional[UserType] = AnonymousUser()
-            if payload.get("email", False):
-                user = User.objects.filter(email=payload["email"]).first()
-                if not user:
-                    user, _ = User.objects.get_or_create(
-                        username=payload["email"], email=payload["email"]
-                    )
-            try:
-                api_agent = Group.objects.get(
-                    name=API_AGENT_GROUP_NAME_FORMAT.format(
-                        prefix=API_AGENT_PREFIX, api_agent=str(UUID(payload["api"]))
-                    )
-                )
-            except (ObjectDoesNotExist, ValueError):
-                raise AuthenticationFailed("Group not exists")
-            except KeyError:
-                raise AuthenticationFailed("Cannot found API info in the payload")
-            attach_permission_functions(api_agent)
-            setattr(user, API_AGENT_PROPERTY_NAME, api_agent)
-            return (user, payload)
-        raise AuthenticationFailed()
+            payload = self.validate_token(headers)
+            started = record_phase("upstream_validation", started)
+            if self.lazy_user:
+                # A bad API id still fails here, a missing group fails when the agent is used
+                get_api_agent_group_name(payload)
+                record_authentication()
+                return (typing.cast(UserType, LazyUser(self, payload)), payload)
+            user = self.get_user(payload)
+            started = record_phase("user_lookup", started)
+            api_agent = self.get_api_agent(payload)
+            record_phase("group_resolution", started)
+        except APIException as e:
+            record_authentication(e)
+            raise
+        record_authentication()
+        setattr(user, API_AGENT_PROPERTY_NAME, api_agent)
+        return (user, payload)
 
     def authenticate_header(self, request: Request) -> str:
         return "{} realm={}".format("SSO", "api")
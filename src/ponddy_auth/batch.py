@@ -0,0 +1,232 @@
+import copy
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, Group
+from rest_framework.exceptions import APIException, AuthenticationFailed
+
+from .agents import resolve_api_agents
+from .authentication import (
+    API_AGENT_PROPERTY_NAME,
+    AuthServerError,
+    InvalidToken,
+    MissingAPIAgent,
+    Payload,
+    SSOAuthentication,
+    User,
+    UserType,
+    ValidationHeaders,
+    attach_permission_functions,
+    get_api_agent_group_name,
+    get_token_fingerprint,
+    is_token_rejection,
+    is_upstream_error,
+    record_authentication,
+)
+from .transport import (
+    VALIDATION_POOL_SIZE,
+    get_validation_session,
+    get_validation_timeout,
+)
+
+AUTH_TOKEN_BATCH_VALID_URL = getattr(settings, "AUTH_TOKEN_BATCH_VALID_URL", None)
+BATCH_MAX_WORKERS = getattr(settings, "PONDDY_AUTH_BATCH_MAX_WORKERS", VALIDATION_POOL_SIZE)
+
+Validation = typing.Union[Payload, APIException]
+
+
+class BatchResult(typing.NamedTuple):
+    user: typing.Optional[UserType]
+    payload: typing.Optional[Payload]
+    error: typing.Optional[APIException]
+
+
+def get_batch_headers(item: typing.Mapping[str, typing.Any]) -> ValidationHeaders:
+    token = item["authorization"]
+    return {
+        "authorization": token.encode("utf-8") if isinstance(token, str) else token,
+        "app": item.get("app", None),
+        "api": item.get("api", None),
+        "status": str(item.get("status", None)),
+    }
+
+
+def serialize_headers(headers: ValidationHeaders) -> typing.Dict[str, typing.Any]:
+    return {
+        name: value.decode("utf-8") if isinstance(value, bytes) else value
+        for name, value in headers.items()
+    }
+
+
+def get_stale_or_error(
+    authentication: SSOAuthentication, key: str, error: APIException
+) -> Validation:
+    try:
+        return authentication.get_stale_payload(key, error)
+    except APIException as e:
+        return e
+
+
+def get_batch_results(
+    response: requests.Response, count: int
+) -> typing.Optional[typing.List[typing.Tuple[int, typing.Any]]]:
+    """Return the status and the payload of the ``count`` results, ``None`` if malformed."""
+    try:
+        results = [
+            (result["status"], result.get("payload")) for result in response.json()["results"]
+        ]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+    if len(results) != count:
+        return None
+    for status_code, payload in results:
+        if not isinstance(status_code, int):
+            return None
+        if 200 <= status_code < 300 and not isinstance(payload, dict):
+            return None
+    return results
+
+
+def request_batch_validation(
+    authentication: SSOAuthentication,
+    pending: typing.Dict[str, ValidationHeaders],
+    url: str,
+) -> typing.Dict[str, Validation]:
+    """Validate every pending token with one call to ``url``, ``AUTH_TOKEN_BATCH_VALID_URL``.
+
+    The endpoint receives ``{"tokens": [<validation headers>, ...]}`` and answers
+    ``{"results": [{"status": <status code>, "payload": <payload>}, ...]}`` in the same order.
+    """
+    error: typing.Optional[APIException] = None
+    results: typing.Optional[typing.List[typing.Tuple[int, typing.Any]]] = None
+    try:
+        authentication.check_validation_circuit()
+        response = get_validation_session().post(
+            url,
+            json={"tokens": [serialize_headers(headers) for headers in pending.values()]},
+            timeout=get_validation_timeout(),
+        )
+    except APIException as e:
+        error = e
+    except Exception as e:
+        error = authentication.get_validation_exception(e, isinstance(e, requests.Timeout))
+    else:
+        results = get_batch_results(response, len(pending)) if response.ok else None
+        authentication.record_validation_outcome(results is not None)
+    if results is None:
+        error = error or AuthServerError()
+        return {key: get_stale_or_error(authentication, key, error) for key in pending}
+
+    validations: typing.Dict[str, Validation] = {}
+    for key, (status_code, payload) in zip(pending, results):
+        if 200 <= status_code < 300:
+            validations[key] = payload
+            authentication.cache_validation(key, payload)
+        elif is_upstream_error(status_code):
+            validations[key] = get_stale_or_error(authentication, key, AuthServerError())
+        elif is_token_rejection(status_code):
+            validations[key] = InvalidToken()
+            authentication.rejected_token_cache.set(key, True)
+        else:
+            validations[key] = AuthenticationFailed()
+    return validations
+
+
+def validate_batch(
+    authentication: SSOAuthentication, unique: typing.Dict[str, ValidationHeaders]
+) -> typing.Dict[str, Validation]:
+    validations: typing.Dict[str, Validation] = {}
+    pending: typing.Dict[str, ValidationHeaders] = {}
+    for key, headers in unique.items():
+        try:
+            payload = authentication.verify_locally(headers)
+            if payload is None:
+                payload = authentication.get_cached_payload(key)
+        except APIException as e:
+            validations[key] = e
+            continue
+        if payload is None:
+            pending[key] = headers
+        else:
+            validations[key] = payload
+
+    if pending and AUTH_TOKEN_BATCH_VALID_URL:
+        validations.update(
+            request_batch_validation(authentication, pending, AUTH_TOKEN_BATCH_VALID_URL)
+        )
+    elif pending:
+
+        def fetch(item: typing.Tuple[str, ValidationHeaders]) -> Validation:
+            try:
+                return authentication.fetch_validation(*item)
+            except APIException as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=min(BATCH_MAX_WORKERS, len(pending))) as executor:
+            validations.update(zip(pending, executor.map(fetch, pending.items())))
+    return validations
+
+
+def get_users(emails: typing.Iterable[str]) -> typing.Dict[str, UserType]:
+    emails = set(emails)
+    users: typing.Dict[str, UserType] = {}
+    for user in User.objects.filter(email__in=emails).order_by("pk"):
+        users.setdefault(user.email, user)
+    for email in emails - set(users):
+        users[email], _ = User.objects.get_or_create(username=email, email=email)
+    return users
+
+
+def authenticate_batch(
+    items: typing.Iterable[typing.Mapping[str, typing.Any]],
+    authentication: typing.Optional[SSOAuthentication] = None,
+) -> typing.List[BatchResult]:
+    """Authenticate many tokens at once, the results are in the order of ``items``.
+
+    Each item holds the ``authorization`` token and the optional ``app``, ``api`` and ``status``
+    headers. The duplicated tokens are validated once, the users and the API agent groups of the
+    whole batch are fetched with one query each.
+    """
+    authentication = authentication or SSOAuthentication()
+    keys = []
+    unique: typing.Dict[str, ValidationHeaders] = {}
+    for item in items:
+        headers = get_batch_headers(item)
+        key = get_token_fingerprint(headers)
+        keys.append(key)
+        unique.setdefault(key, headers)
+    validations = validate_batch(authentication, unique)
+
+    group_names: typing.Dict[str, str] = {}
+    for key, validation in list(validations.items()):
+        if isinstance(validation, APIException):
+            continue
+        try:
+            group_names[key] = get_api_agent_group_name(validation)
+        except APIException as e:
+            validations[key] = e
+    payloads = {key: value for key, value in validations.items() if isinstance(value, dict)}
+    users = get_users(payload["email"] for payload in payloads.values() if payload.get("email"))
+    api_agents = resolve_api_agents(group_names.values())
+
+    results = []
+    for key in keys:
+        validation = validations[key]
+        if isinstance(validation, APIException):
+            results.append(BatchResult(user=None, payload=None, error=validation))
+            continue
+        api_agent: typing.Optional[Group] = api_agents.get(group_names[key])
+        if api_agent is None:
+            error = MissingAPIAgent("Group not exists")
+            results.append(BatchResult(user=None, payload=None, error=error))
+            continue
+        attach_permission_functions(api_agent)
+        email = validation.get("email")
+        user = copy.copy(users[email]) if email else AnonymousUser()
+        setattr(user, API_AGENT_PROPERTY_NAME, api_agent)
+        results.append(BatchResult(user=user, payload=dict(validation), error=None))
+    for result in results:
+        record_authentication(result.error)
+    return results
@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+import typing
+from collections import deque
+
+logger = logging.getLogger(__file__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+StateListener = typing.Callable[["CircuitBreaker", str, str], None]
+
+
+class BreakerStats(typing.NamedTuple):
+    state: str
+    failure_rate: float
+    calls: int
+    rejected: int
+    opened: int
+
+
+class CircuitBreaker:
+    """Stop calling a failing dependency until it has had time to recover.
+
+    The breaker opens when at least ``failure_rate_threshold`` of the last ``window_size`` calls
+    failed (once ``minimum_calls`` calls are recorded), rejects every call for ``open_duration``
+    seconds, then lets ``half_open_calls`` probes through, the first probe result closes it or
+    opens it again.
+    """
+
+    def __init__(
+        self,
+        failure_rate_threshold: float = 0.5,
+        minimum_calls: int = 10,
+        window_size: int = 50,
+        open_duration: float = 30,
+        half_open_calls: int = 1,
+        timer: typing.Callable[[], float] = time.monotonic,
+    ):
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self.timer = timer
+        self.listeners: typing.List[StateListener] = []
+        self._outcomes: "deque[bool]" = deque(maxlen=window_size)
+        self._state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            changes = self._refresh_state()
+            state = self._state
+        self._notify(changes)
+        return state
+
+    def add_listener(self, listener: StateListener) -> None:
+        """Call ``listener(breaker, old_state, new_state)`` on every state change."""
+        self.listeners.append(listener)
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            changes = self._refresh_state()
+            allowed = True
+            if self._state == STATE_OPEN:
+                allowed = False
+            elif self._state == STATE_HALF_OPEN:
+                allowed = self._probes < self.half_open_calls
+                if allowed:
+                    self._probes += 1
+            if not allowed:
+                self.rejected += 1
+        self._notify(changes)
+        return allowed
+
+    def record_success(self) -> None:
+        self._record(True)
+
+    def record_failure(self) -> None:
+        self._record(False)
+
+    def stats(self) -> BreakerStats:
+        with self._lock:
+            changes = self._refresh_state()
+            stats = BreakerStats(
+                state=self._state,
+                failure_rate=self._failure_rate(),
+                calls=len(self._outcomes),
+                rejected=self.rejected,
+                opened=self.opened,
+            )
+        self._notify(changes)
+        return stats
+
+    def _record(self, success: bool) -> None:
+        with self._lock:
+            changes = self._refresh_state()
+            if self._state == STATE_HALF_OPEN:
+                changes.append(self._transit(STATE_CLOSED if success else STATE_OPEN))
+            elif self._state == STATE_CLOSED:
+                self._outcomes.append(success)
+                enough_calls = len(self._outcomes) >= self.minimum_calls
+                if enough_calls and self._failure_rate() >= self.failure_rate_threshold:
+                    changes.append(self._transit(STATE_OPEN))
+        self._notify(changes)
+
+    def _failure_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def _refresh_state(self) -> typing.List[typing.Tuple[str, str]]:
+        if self._state == STATE_OPEN and self.timer() - self._opened_at >= self.open_duration:
+            return [self._transit(STATE_HALF_OPEN)]
+        return []
+
+    def _transit(self, state: str) -> typing.Tuple[str, str]:
+        old_state, self._state = self._state, state
+        self._probes = 0
+        if state == STATE_OPEN:
+            self._opened_at = self.timer()
+            self.opened += 1
+        elif state == STATE_CLOSED:
+            self._outcomes.clear()
+        return (old_state, state)
+
+    def _notify(self, changes: typing.List[typing.Tuple[str, str]]) -> None:
+        for old_state, new_state in changes:
+            logger.warning("Circuit breaker %s -> %s", old_state, new_state)
+            for listener in self.listeners:
+                listener(self, old_state, new_state)
@@ -0,0 +1,252 @@
+import hashlib
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+VT = typing.TypeVar("VT")
+
+# Bump it when the stored form changes, the entries of the other versions are ignored
+CACHE_FORMAT_VERSION = 2
+
+
+class CacheStats(typing.NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    size: int
+    maxsize: int
+
+
+class _Entry(typing.Generic[VT]):
+    __slots__ = ("value", "expires_at", "stale_until")
+
+    def __init__(self, value: VT, expires_at: float, stale_until: float):
+        self.value = value
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+class TTLCache(typing.Generic[VT]):
+    """Thread-safe LRU cache whose entries also expire after a TTL.
+
+    A ``maxsize`` lower than 1 disables the cache, every lookup is a miss and nothing is stored.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        timer: typing.Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data: "OrderedDict[str, _Entry[VT]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def get(self, key: str) -> typing.Optional[VT]:
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key: str) -> typing.Tuple[typing.Optional[VT], float]:
+        """Return the value and the seconds left before it expires, ``(None, 0)`` on a miss."""
+        if not self.enabled:
+            return None, 0
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, 0
+            now = self.timer()
+            if entry.expires_at <= now:
+                if entry.stale_until <= now:
+                    del self._data[key]
+                    self.expirations += 1
+                self.misses += 1
+                return None, 0
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry.value, entry.expires_at - now
+
+    def get_stale(self, key: str) -> typing.Optional[VT]:
+        """Return the value even if it expired, as long as it is kept as a stale copy."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry.stale_until <= self.timer():
+                return None
+            return entry.value
+
+    def set(
+        self, key: str, value: VT, ttl: typing.Optional[float] = None, stale_ttl: float = 0
+    ) -> None:
+        """Store ``value``, ``ttl`` can only shorten the default TTL of the cache.
+
+        The expired entry is still returned by ``get_stale`` until ``stale_ttl`` seconds pass.
+        """
+        if not self.enabled:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 and stale_ttl <= 0:
+            return
+        now = self.timer()
+        with self._lock:
+            self._data[key] = _Entry(value, now + ttl, now + max(ttl, stale_ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate: typing.Callable[[VT], bool]) -> None:
+        with self._lock:
+            for key in [key for key, entry in self._data.items() if predicate(entry.value)]:
+                del self._data[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                expirations=self.expirations,
+                size=len(self._data),
+                maxsize=self.maxsize,
+            )
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def identity(value: typing.Any) -> typing.Any:
+    return value
+
+
+class DjangoCache(typing.Generic[VT]):
+    """A ``TTLCache`` look-alike kept in the Django cache ``alias``, shared by its every user.
+
+    The keys are fingerprinted under the ``namespace``, ``encode`` turns the values into the
+    compact form stored with their expiry time. A shared cache cannot be scanned, so
+    ``delete_where`` and ``clear`` drop every entry of the namespace by bumping its generation.
+    """
+
+    def __init__(
+        self,
+        alias: str,
+        namespace: str,
+        ttl: float,
+        encode: typing.Callable[[VT], typing.Any] = identity,
+        decode: typing.Callable[[typing.Any], VT] = identity,
+        timer: typing.Callable[[], float] = time.time,
+    ):
+        self.alias = alias
+        self.namespace = namespace
+        self.ttl = ttl
+        self.encode = encode
+        self.decode = decode
+        self.timer = timer
+        self.generation_key = f"ponddy_auth:{namespace}:generation"
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return True
+
+    @property
+    def cache(self) -> typing.Any:
+        # ``caches`` hands every thread its own connection
+        return caches[self.alias]
+
+    def make_key(self, key: str) -> str:
+        return "ponddy_auth:{}:{}".format(
+            self.namespace, hashlib.sha256(key.encode("utf-8")).hexdigest()
+        )
+
+    def get_entry(self, key: str) -> typing.Optional[typing.Tuple[float, float, typing.Any]]:
+        cache_key = self.make_key(key)
+        found = self.cache.get_many([cache_key, self.generation_key], version=CACHE_FORMAT_VERSION)
+        entry = found.get(cache_key)
+        if entry is None or entry[0] != found.get(self.generation_key, 0):
+            return None
+        _, expires_at, stale_expires_at, value = entry
+        return float(expires_at), float(stale_expires_at), value
+
+    def get(self, key: str) -> typing.Optional[VT]:
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key: str) -> typing.Tuple[typing.Optional[VT], float]:
+        entry = self.get_entry(key)
+        ttl = entry[0] - self.timer() if entry is not None else 0
+        with self._lock:
+            if ttl > 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None or ttl <= 0:
+            return None, 0
+        return self.decode(entry[2]), ttl
+
+    def get_stale(self, key: str) -> typing.Optional[VT]:
+        entry = self.get_entry(key)
+        if entry is None or entry[1] <= self.timer():
+            return None
+        return self.decode(entry[2])
+
+    def set(
+        self, key: str, value: VT, ttl: typing.Optional[float] = None, stale_ttl: float = 0
+    ) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        timeout = max(ttl, stale_ttl)
+        if timeout <= 0:
+            return
+        now = self.timer()
+        generation = self.cache.get(self.generation_key, 0, version=CACHE_FORMAT_VERSION)
+        self.cache.set(
+            self.make_key(key),
+            (generation, now + ttl, now + timeout, self.encode(value)),
+            timeout=timeout,
+            version=CACHE_FORMAT_VERSION,
+        )
+
+    def delete(self, key: str) -> None:
+        self.cache.delete(self.make_key(key), version=CACHE_FORMAT_VERSION)
+
+    def delete_where(self, predicate: typing.Callable[[VT], bool]) -> None:
+        self.clear()
+
+    def clear(self) -> None:
+        try:
+            self.cache.incr(self.generation_key, version=CACHE_FORMAT_VERSION)
+        except ValueError:
+            self.cache.set(self.generation_key, 1, timeout=None, version=CACHE_FORMAT_VERSION)
+
+    def stats(self) -> CacheStats:
+        """Return the counters, the size of a shared cache is unknown and reported as ``-1``."""
+        with self._lock:
+            return CacheStats(
+                hits=self.hits, misses=self.misses, evictions=0, expirations=0, size=-1, maxsize=-1
+            )
+
+
+AnyCache = typing.Union[TTLCache[VT], DjangoCache[VT]]
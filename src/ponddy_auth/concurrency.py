@@ -0,0 +1,165 @@
+import logging
+import os
+import threading
+import typing
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+VT = typing.TypeVar("VT")
+logger = logging.getLogger(__file__)
+
+
+class FlightStats(typing.NamedTuple):
+    leaders: int
+    waiters: int
+    fallbacks: int
+    in_flight: int
+
+
+class _Call(typing.Generic[VT]):
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: typing.Optional[VT] = None
+        self.error: typing.Optional[BaseException] = None
+
+
+class SingleFlight(typing.Generic[VT]):
+    """Merge the concurrent calls of the same key into one call shared by every caller.
+
+    The first caller of a key runs ``function``, the others wait for its result or its error at
+    most ``timeout`` seconds, then give up on the hanging leader and run ``function`` on their own.
+    """
+
+    def __init__(self, timeout: typing.Optional[float] = None):
+        self.timeout = timeout
+        self._calls: typing.Dict[str, _Call[VT]] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.waiters = 0
+        self.fallbacks = 0
+
+    def do(self, key: str, function: typing.Callable[[], VT]) -> VT:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.waiters += 1
+
+        if leader:
+            try:
+                result = call.result = function()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.event.set()
+            return result
+
+        if not call.event.wait(self.timeout):
+            with self._lock:
+                self.fallbacks += 1
+            return function()
+        if call.error is not None:
+            raise call.error
+        return typing.cast(VT, call.result)
+
+    def stats(self) -> FlightStats:
+        with self._lock:
+            return FlightStats(
+                leaders=self.leaders,
+                waiters=self.waiters,
+                fallbacks=self.fallbacks,
+                in_flight=len(self._calls),
+            )
+
+
+class RefresherStats(typing.NamedTuple):
+    submitted: int
+    skipped: int
+    failed: int
+    in_flight: int
+
+
+class Refresher:
+    """Run the refresh of a key on a small pool of background threads, once at a time.
+
+    A key already being refreshed is skipped, and so is every key while ``max_pending`` refreshes
+    are queued or running, the caller keeps the value it has. The threads are started on the
+    first refresh, and again in a forked child.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: typing.Optional[int] = None):
+        self.max_workers = max_workers
+        self.max_pending = max_workers * 4 if max_pending is None else max_pending
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+        self._keys: typing.Set[str] = set()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.skipped = 0
+        self.failed = 0
+        _refreshers.add(self)
+
+    def _reset(self) -> None:
+        # The threads of the parent do not exist in the child
+        self._executor = None
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, function: typing.Callable[[], typing.Any]) -> bool:
+        with self._lock:
+            if key in self._keys or len(self._keys) >= self.max_pending:
+                self.skipped += 1
+                return False
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="ponddy_auth_refresh"
+                )
+            self._keys.add(key)
+            self.submitted += 1
+            self._executor.submit(self._run, key, function)
+        return True
+
+    def _run(self, key: str, function: typing.Callable[[], typing.Any]) -> None:
+        try:
+            function()
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            logger.info("Refresh failed, %s", e)
+        finally:
+            with self._lock:
+                self._keys.discard(key)
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self) -> RefresherStats:
+        with self._lock:
+            return RefresherStats(
+                submitted=self.submitted,
+                skipped=self.skipped,
+                failed=self.failed,
+                in_flight=len(self._keys),
+            )
+
+
+_refreshers: "weakref.WeakSet[Refresher]" = weakref.WeakSet()
+
+
+def _reset_refreshers() -> None:
+    for refresher in list(_refreshers):
+        refresher._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_refreshers)
@@ -0,0 +1,135 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import typing
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+LOG_SUCCESS_SAMPLE_RATE = getattr(settings, "PONDDY_AUTH_LOG_SUCCESS_SAMPLE_RATE", 1.0)
+LOG_MAX_FIELD_LENGTH = getattr(settings, "PONDDY_AUTH_LOG_MAX_FIELD_LENGTH", 256)
+LOG_QUEUE = getattr(settings, "PONDDY_AUTH_LOG_QUEUE", False)
+
+event_logger = logging.getLogger("ponddy_auth")
+
+_listener: typing.Optional[QueueListener] = None
+_queue_handler: typing.Optional[QueueHandler] = None
+_listener_lock = threading.Lock()
+
+
+class AuthEvent:
+    """An auth event formatted to JSON only when a handler emits it."""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, **fields: typing.Any):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return json.dumps(
+            {name: truncate(value) for name, value in self.fields.items()}, default=str
+        )
+
+
+def truncate(value: typing.Any, max_length: typing.Optional[int] = None) -> typing.Any:
+    max_length = LOG_MAX_FIELD_LENGTH if max_length is None else max_length
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    if isinstance(value, str) and len(value) > max_length:
+        return f"{value[:max_length]}...({len(value)} chars)"
+    return value
+
+
+class RawQueueHandler(QueueHandler):
+    """Put a copy of the record in the queue as is, the handlers of the listener format it."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # ``QueueHandler.prepare`` formats the record, i.e. dumps the ``AuthEvent``, on the caller
+        return copy.copy(record)
+
+
+class AncestorHandler(logging.Handler):
+    """Hand a record to the handlers the ancestors of ``logger`` have when it is emitted."""
+
+    def __init__(self, logger: logging.Logger):
+        super().__init__()
+        self.logger = logger
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.logger.parent is not None:
+            self.logger.parent.callHandlers(record)
+
+
+def install_queue_handler(logger: logging.Logger = event_logger) -> QueueListener:
+    """Hand the records of ``logger`` to its handlers and its ancestors' on a background thread.
+
+    The request thread only puts the records in a queue, ``QueueListener`` does the I/O. The
+    handlers of the ancestors are looked up for every record, so the ones configured later apply.
+    """
+    global _listener, _queue_handler
+    with _listener_lock:
+        if _listener is not None:
+            return _listener
+        handlers = list(logger.handlers)
+        for handler in handlers:
+            logger.removeHandler(handler)
+        if logger.propagate:
+            handlers.append(AncestorHandler(logger))
+        records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        _queue_handler = RawQueueHandler(records)
+        logger.addHandler(_queue_handler)
+        logger.propagate = False
+        _listener = QueueListener(records, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_listener)
+        return _listener
+
+
+def stop_listener() -> None:
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart_listener() -> None:
+    # The thread of the listener does not exist in a forked child, the records would pile up
+    global _listener, _listener_lock
+    _listener_lock = threading.Lock()
+    if _listener is None or _queue_handler is None:
+        return
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _queue_handler.queue = records
+    _listener = QueueListener(records, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+def log_event(level: int, event: str, sampled: bool = False, **fields: typing.Any) -> None:
+    """Log the auth ``event``, sample it by ``LOG_SUCCESS_SAMPLE_RATE`` when ``sampled``."""
+    if not event_logger.isEnabledFor(level):
+        return
+    if sampled and LOG_SUCCESS_SAMPLE_RATE < 1 and random.random() >= LOG_SUCCESS_SAMPLE_RATE:
+        return
+    if LOG_QUEUE and _listener is None:
+        install_queue_handler()
+    event_logger.log(level, "%s", AuthEvent(event=event, **fields), extra={"auth_event": event})
+
+
+def log_validation(ok: bool, status_code: typing.Any, text: str, upstream_error: bool) -> None:
+    if ok:
+        log_event(logging.INFO, "validation", sampled=True, status=status_code, outcome="valid")
+    else:
+        log_event(
+            logging.WARNING if upstream_error else logging.INFO,
+            "validation",
+            status=status_code,
+            outcome="upstream_error" if upstream_error else "invalid_token",
+            body=text,
+        )
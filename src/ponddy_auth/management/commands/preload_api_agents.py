@@ -0,0 +1,15 @@
+import typing
+
+from django.core.management.base import BaseCommand
+
+from ...agents import api_agent_cache, preload_api_agents
+
+
+class Command(BaseCommand):
+    help = "Load every API agent group, and write them to the API agent cache when it is shared."
+
+    def handle(self, *args: typing.Any, **options: typing.Any) -> None:
+        agents = preload_api_agents()
+        for name, agent in agents.items():
+            api_agent_cache.set(name, agent)
+        self.stdout.write(f"Preloaded {len(agents)} API agents")
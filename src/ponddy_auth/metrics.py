@@ -0,0 +1,176 @@
+import abc
+import bisect
+import threading
+import time
+import typing
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.utils.module_loading import import_string
+
+METRICS_EXPORTER = getattr(
+    settings, "PONDDY_AUTH_METRICS_EXPORTER", "ponddy_auth.metrics.InMemoryExporter"
+)
+
+AUTHENTICATIONS = "ponddy_auth_authentications_total"
+PERMISSION_CHECKS = "ponddy_auth_permission_checks_total"
+PHASE_SECONDS = "ponddy_auth_phase_seconds"
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_INVALID_TOKEN = "invalid_token"
+OUTCOME_MISSING_GROUP = "missing_group"
+OUTCOME_UPSTREAM_ERROR = "upstream_error"
+
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = typing.Optional[typing.Mapping[str, str]]
+MetricKey = typing.Tuple[str, typing.Tuple[typing.Tuple[str, str], ...]]
+
+
+class MetricsExporter(abc.ABC):
+    """The interface the authentication hot path reports its counters and latencies to."""
+
+    @abc.abstractmethod
+    def increment(self, name: str, labels: Labels = None, value: float = 1) -> None:
+        """Add ``value`` to the counter ``name``."""
+
+    @abc.abstractmethod
+    def observe(self, name: str, value: float, labels: Labels = None) -> None:
+        """Record ``value`` in the histogram ``name``."""
+
+
+class NullExporter(MetricsExporter):
+    def increment(self, name: str, labels: Labels = None, value: float = 1) -> None:
+        pass
+
+    def observe(self, name: str, value: float, labels: Labels = None) -> None:
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def percentile(self, percent: float) -> float:
+        """Return the upper bound of the bucket the ``percent`` percentile falls into."""
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class InMemoryExporter(MetricsExporter):
+    """Keep the counters and the histograms in memory, read them in tests or scrape ``render``."""
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters: typing.Dict[MetricKey, float] = {}
+        self.histograms: typing.Dict[MetricKey, Histogram] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(name: str, labels: Labels) -> MetricKey:
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def increment(self, name: str, labels: Labels = None, value: float = 1) -> None:
+        key = self.get_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Labels = None) -> None:
+        key = self.get_key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def get_counter(self, name: str, **labels: str) -> float:
+        return self.counters.get(self.get_key(name, labels), 0)
+
+    def get_histogram(self, name: str, **labels: str) -> typing.Optional[Histogram]:
+        return self.histograms.get(self.get_key(name, labels))
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+
+        def format_labels(labels: typing.Iterable[typing.Tuple[str, str]]) -> str:
+            joined = ",".join(f'{name}="{value}"' for name, value in labels)
+            return f"{{{joined}}}" if joined else ""
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    bucket_labels = format_labels(labels + (("le", str(bound)),))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+_exporter: typing.Optional[MetricsExporter] = None
+
+
+def get_metrics_exporter() -> MetricsExporter:
+    global _exporter
+    if _exporter is None:
+        exporter = METRICS_EXPORTER
+        _exporter = import_string(exporter)() if isinstance(exporter, str) else exporter
+    return _exporter
+
+
+def set_metrics_exporter(exporter: MetricsExporter) -> None:
+    global _exporter
+    _exporter = exporter
+
+
+def record_phase(phase: str, started: float) -> float:
+    """Observe the time spent in ``phase`` since ``started``, return the new start time."""
+    now = time.perf_counter()
+    get_metrics_exporter().observe(PHASE_SECONDS, now - started, {"phase": phase})
+    return now
+
+
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    exporter = get_metrics_exporter()
+    if not isinstance(exporter, InMemoryExporter):
+        return HttpResponse(status=404)
+    return HttpResponse(exporter.render(), content_type="text/plain; version=0.0.4")
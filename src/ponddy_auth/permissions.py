@@ -1,9 +1,23 @@
+import time
+import typing
+
 from django.conf import settings
+from django.db.models import Model, Q, QuerySet, Value
 from rest_framework.permissions import DjangoModelPermissions
 from rest_framework.request import Request
 from rest_framework.views import APIView
 
+from .metrics import PERMISSION_CHECKS, get_metrics_exporter, record_phase
+
 API_AGENT_PROPERTY_NAME = getattr(settings, "API_AGENT_PROPERTY_NAME", "_api_agent")
+API_AGENT_FIRST = getattr(settings, "PONDDY_AUTH_API_AGENT_FIRST", False)
+PERMISSION_DECISIONS_NAME = "_ponddy_auth_permission_decisions"
+GRANTED_ANNOTATION_NAME = "_ponddy_auth_granted"
+
+RequiredPermissionsKey = typing.Tuple[type, str, typing.Type[Model]]
+DecisionKey = typing.Tuple[type, str, typing.Type[Model]]
+
+_required_permissions: typing.Dict[RequiredPermissionsKey, typing.List[str]] = {}
 
 
 class SSODjangoModelPermissions(DjangoModelPermissions):
@@ -17,10 +31,102 @@ class SSODjangoModelPermissions(DjangoModelPermissions):
         "DELETE": ["%(app_label)s.delete_%(model_name)s"],
     }
 
+    api_agent_first: bool = API_AGENT_FIRST
+
+    def get_required_permissions(
+        self, method: str, model_cls: typing.Type[Model]
+    ) -> typing.List[str]:
+        key = (type(self), method, model_cls)
+        perms = _required_permissions.get(key)
+        if perms is None:
+            perms = super().get_required_permissions(method, model_cls)
+            _required_permissions[key] = perms
+        return perms
+
     def has_permission(self, request: Request, view: APIView) -> bool:
+        started = time.perf_counter()
+        if self.api_agent_first:
+            allowed = self.check_permission_once(request, view)
+        else:
+            allowed = self.check_permission(request, view)
+        record_phase("permission_check", started)
+        get_metrics_exporter().increment(
+            PERMISSION_CHECKS, {"result": "allowed" if allowed else "denied"}
+        )
+        return allowed
+
+    def check_permission_once(self, request: Request, view: APIView) -> bool:
+        """Decide once per request, method and model."""
+        decisions: typing.Optional[typing.Dict[DecisionKey, bool]] = request.__dict__.get(
+            PERMISSION_DECISIONS_NAME
+        )
+        if decisions is None:
+            decisions = request.__dict__[PERMISSION_DECISIONS_NAME] = {}
+        key = (type(self), str(request.method), self._queryset(view).model)
+        if key not in decisions:
+            decisions[key] = self.check_permission(request, view)
+        return decisions[key]
+
+    def check_permission(self, request: Request, view: APIView) -> bool:
         api_agent = getattr(request.user, API_AGENT_PROPERTY_NAME, None)
         queryset = self._queryset(view)
         perms = None
         if request.method:
             perms = self.get_required_permissions(request.method, queryset.model)
-        return super().has_permission(request, view) or (api_agent and api_agent.has_perms(perms))
+        if self.api_agent_first and api_agent is not None:
+            # The user permissions are only loaded when the agent does not grant the access
+            return bool(api_agent.has_perms(perms) or super().has_permission(request, view))
+        return bool(
+            super().has_permission(request, view) or (api_agent and api_agent.has_perms(perms))
+        )
+
+
+class SSODjangoObjectPermissions(SSODjangoModelPermissions):
+    """Limit the API agents to the objects the view grants them.
+
+    The view sets ``api_agent_lookup_field``, the lookup from its model to the agent ``Group``
+    (e.g. ``"groups"`` or ``"owner__groups"``). A caller whose user permissions do not grant the
+    access only reaches the objects matching ``{api_agent_lookup_field: agent.pk}``,
+    ``SSOAPIAgentFilterBackend`` applies it to the whole queryset at once.
+    """
+
+    def get_api_agent_filter(self, request: Request, view: APIView) -> typing.Optional[Q]:
+        lookup_field = getattr(view, "api_agent_lookup_field", None)
+        api_agent = getattr(request.user, API_AGENT_PROPERTY_NAME, None)
+        if lookup_field is None or api_agent is None or not request.method:
+            return None
+        perms = self.get_required_permissions(request.method, self._queryset(view).model)
+        if request.user.is_authenticated and request.user.has_perms(perms):
+            return None
+        return Q(**{lookup_field: api_agent.pk})
+
+    def filter_queryset(
+        self, request: Request, queryset: "QuerySet[Model]", view: APIView
+    ) -> "QuerySet[Model]":
+        api_agent_filter = self.get_api_agent_filter(request, view)
+        if api_agent_filter is None:
+            return queryset
+        # The objects of the filtered queryset are known to be granted, see has_object_permission
+        granted: "QuerySet[Model]" = queryset.filter(api_agent_filter).annotate(
+            **{GRANTED_ANNOTATION_NAME: Value(True)}
+        )
+        return granted
+
+    def has_object_permission(self, request: Request, view: APIView, obj: typing.Any) -> bool:
+        if getattr(obj, GRANTED_ANNOTATION_NAME, False):
+            return True
+        api_agent_filter = self.get_api_agent_filter(request, view)
+        if api_agent_filter is None:
+            return True
+        return bool(type(obj)._default_manager.filter(api_agent_filter, pk=obj.pk).exists())
+
+
+class SSOAPIAgentFilterBackend:
+    """Filter the list of the API agents with ``SSODjangoObjectPermissions`` in one query."""
+
+    permission_class = SSODjangoObjectPermissions
+
+    def filter_queryset(
+        self, request: Request, queryset: "QuerySet[Model]", view: APIView
+    ) -> "QuerySet[Model]":
+        return self.permission_class().filter_queryset(request, queryset, view)
@@ -0,0 +1,245 @@
+import itertools
+import json
+import random
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from jose import JWTError, jwt
+
+from .utils import APIClient
+
+Payload = typing.Dict[str, typing.Any]
+PayloadOption = typing.Union[
+    typing.Mapping[str, typing.Any], typing.Callable[[Payload], Payload], None
+]
+
+
+class ServerStats(typing.NamedTuple):
+    requests: int
+    valid: int
+    invalid: int
+    errors: int
+
+
+class LoadResult(typing.NamedTuple):
+    requests: int
+    failures: int
+    elapsed: float
+    throughput: float
+    p50: float
+    p90: float
+    p99: float
+
+
+class ValidationRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_HTTPServer"
+
+    def do_GET(self) -> None:
+        validation = self.server.validation
+        status, payload = validation.answer(
+            {name: self.headers.get(name) for name in ("authorization", "app", "api", "status")}
+        )
+        self.send_json(status, payload)
+
+    def do_POST(self) -> None:
+        validation = self.server.validation
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        results = []
+        for headers in body.get("tokens", []):
+            status, payload = validation.answer(headers)
+            results.append({"status": status, "payload": payload})
+        self.send_json(200, {"results": results})
+
+    def send_json(self, status: int, data: typing.Any) -> None:
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        pass
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    # ``http.server.ThreadingHTTPServer`` is new in Python 3.7
+    daemon_threads = True
+    request_queue_size = 128
+    validation: "ValidationServer"
+
+
+class ValidationServer:
+    """A local stand-in of the auth server behind ``AUTH_TOKEN_VALID_URL``.
+
+    It validates the tokens signed by ``APIClient`` with the ``secrets`` of the API client ids and
+    answers their claims, patched by ``payload`` when it is a mapping or replaced by its result
+    when it is a callable. Every answer waits ``latency`` seconds, ``error_rate`` of them fail
+    with a 500. ``POST`` requests are answered like ``AUTH_TOKEN_BATCH_VALID_URL``.
+    """
+
+    def __init__(
+        self,
+        secrets: typing.Mapping[str, str],
+        latency: float = 0,
+        error_rate: float = 0,
+        payload: PayloadOption = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.secrets = secrets
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload = payload
+        self.address = (host, port)
+        self.httpd: typing.Optional[_HTTPServer] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.valid = 0
+        self.invalid = 0
+        self.errors = 0
+
+    @property
+    def url(self) -> str:
+        if self.httpd is None:
+            raise RuntimeError("The validation server is not started")
+        host = typing.cast(str, self.httpd.server_address[0])
+        return f"http://{host}:{self.httpd.server_port}/"
+
+    def start(self) -> "ValidationServer":
+        self.httpd = _HTTPServer(self.address, ValidationRequestHandler)
+        self.httpd.validation = self
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.httpd is None:
+            return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd = None
+
+    def __enter__(self) -> "ValidationServer":
+        return self.start()
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.stop()
+
+    def stats(self) -> ServerStats:
+        with self._lock:
+            return ServerStats(
+                requests=self.requests, valid=self.valid, invalid=self.invalid, errors=self.errors
+            )
+
+    def answer(
+        self, headers: typing.Mapping[str, typing.Optional[str]]
+    ) -> typing.Tuple[int, typing.Optional[Payload]]:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+        if self.error_rate and random.random() < self.error_rate:
+            return self.count(500, None)
+        claims = self.verify(headers)
+        if claims is None:
+            return self.count(401, None)
+        if callable(self.payload):
+            return self.count(200, self.payload(claims))
+        return self.count(200, dict(claims, **(self.payload or {})))
+
+    def verify(
+        self, headers: typing.Mapping[str, typing.Optional[str]]
+    ) -> typing.Optional[Payload]:
+        authorization = (headers.get("authorization") or "").split()
+        if len(authorization) != 2:
+            return None
+        try:
+            secret = self.secrets.get(jwt.get_unverified_claims(authorization[1]).get("api"))
+            if secret is None:
+                return None
+            claims: Payload = jwt.decode(authorization[1], secret)
+        except JWTError:
+            return None
+        for name in ("api", "app"):
+            if headers.get(name) is not None and claims.get(name) != headers.get(name):
+                return None
+        return claims
+
+    def count(
+        self, status: int, payload: typing.Optional[Payload]
+    ) -> typing.Tuple[int, typing.Optional[Payload]]:
+        with self._lock:
+            if status == 200:
+                self.valid += 1
+            elif status == 401:
+                self.invalid += 1
+            else:
+                self.errors += 1
+        return status, payload
+
+
+def percentile(latencies: typing.List[float], percent: float) -> float:
+    if not latencies:
+        return 0.0
+    return latencies[round(percent / 100 * (len(latencies) - 1))]
+
+
+def run_load(
+    client: APIClient,
+    url: str,
+    requests: int,
+    concurrency: int = 10,
+    method: str = "GET",
+    sign_every_request: bool = False,
+    **kwargs: typing.Any,
+) -> LoadResult:
+    """Send ``requests`` signed requests to ``url`` from ``concurrency`` threads at once.
+
+    A request fails when it raises or answers a status code of 400 or more, the latencies of the
+    result are in seconds. Build the client with a ``pool_size`` of ``concurrency`` at least.
+    ``sign_every_request`` signs a new token for each request, so the app validates every one
+    of them instead of answering from its token cache.
+    """
+    counter = itertools.count()
+    latencies: typing.List[float] = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def work() -> None:
+        thread_latencies = []
+        thread_failures = 0
+        while next(counter) < requests:
+            request_kwargs = client.sign_attempt(kwargs) if sign_every_request else kwargs
+            started = time.perf_counter()
+            try:
+                failed = client.request(method, url, **request_kwargs).status_code >= 400
+            except Exception:
+                failed = True
+            thread_latencies.append(time.perf_counter() - started)
+            thread_failures += failed
+        with lock:
+            latencies.extend(thread_latencies)
+            failures[0] += thread_failures
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return LoadResult(
+        requests=len(latencies),
+        failures=failures[0],
+        elapsed=elapsed,
+        throughput=len(latencies) / elapsed if elapsed else 0.0,
+        p50=percentile(latencies, 50),
+        p90=percentile(latencies, 90),
+        p99=percentile(latencies, 99),
+    )
@@ -0,0 +1,49 @@
+import os
+import threading
+import typing
+from http.cookiejar import DefaultCookiePolicy
+
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+VALIDATION_POOL_SIZE = getattr(settings, "PONDDY_AUTH_VALIDATION_POOL_SIZE", 10)
+VALIDATION_CONNECT_TIMEOUT = getattr(settings, "PONDDY_AUTH_VALIDATION_CONNECT_TIMEOUT", 3.05)
+VALIDATION_READ_TIMEOUT = getattr(settings, "PONDDY_AUTH_VALIDATION_READ_TIMEOUT", 5)
+
+_session: typing.Optional[Session] = None
+_session_pid: typing.Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def disable_cookies(session: Session) -> None:
+    # The session is shared by every thread, never let a response cookie leak into another call
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+
+def build_pooled_session(pool_size: int) -> Session:
+    session = Session()
+    disable_cookies(session)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_validation_session() -> Session:
+    """Return the process-wide keep-alive session used to reach ``AUTH_TOKEN_VALID_URL``.
+
+    The session is rebuilt in a forked child so workers never share sockets with their parent.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = build_pooled_session(VALIDATION_POOL_SIZE)
+                _session_pid = pid
+    return _session
+
+
+def get_validation_timeout() -> typing.Tuple[float, float]:
+    return (VALIDATION_CONNECT_TIMEOUT, VALIDATION_READ_TIMEOUT)
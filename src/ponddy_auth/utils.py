@@ -1,9 +1,23 @@
+import json
+import os
+import random
+import threading
+import time
 import typing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
 
 from django.conf import settings
 from django.utils import timezone
 from jose import jwt
-from requests import Session
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestConnectionError
+from requests.exceptions import Timeout
+
+from .transport import disable_cookies
 
 APP_NAME_SETTING_NAME = getattr(
     settings, "PONDDY_AUTH_APP_NAME_SETTING_NAME", "PONDDY_AUTH_APP_NAME"
@@ -19,35 +33,423 @@ API_TOKEN_PREFIX_SETTING_NAME = getattr(
     "PONDDY_AUTH_API_TOKEN_PREFIX_SETTING_NAME",
     "PONDDY_AUTH_API_TOKEN_PREFIX",
 )
+API_KEY_ID_SETTING_NAME = getattr(
+    settings, "PONDDY_AUTH_API_KEY_ID_SETTING_NAME", "PONDDY_AUTH_API_KEY_ID"
+)
 
 
 setting_app_name = getattr(settings, APP_NAME_SETTING_NAME, None)
 setting_api_client_id = getattr(settings, API_CLIENT_ID_SETTING_NAME, None)
 setting_api_secret = getattr(settings, API_SECRET_SETTING_NAME, None)
 setting_api_token_prefix = getattr(settings, API_TOKEN_PREFIX_SETTING_NAME, "SSO")
+setting_api_key_id = getattr(settings, API_KEY_ID_SETTING_NAME, None)
+setting_api_token_lifetime = getattr(settings, "PONDDY_AUTH_API_TOKEN_LIFETIME", None)
+setting_api_token_refresh_margin = getattr(settings, "PONDDY_AUTH_API_TOKEN_REFRESH_MARGIN", 30)
+setting_api_max_in_flight = getattr(settings, "PONDDY_AUTH_API_MAX_IN_FLIGHT", 10)
+setting_api_client_pool_size = getattr(settings, "PONDDY_AUTH_API_CLIENT_POOL_SIZE", 10)
+setting_api_client_host_pool_sizes: typing.Mapping[str, int] = getattr(
+    settings, "PONDDY_AUTH_API_CLIENT_HOST_POOL_SIZES", {}
+)
+setting_api_client_idle_timeout = getattr(settings, "PONDDY_AUTH_API_CLIENT_IDLE_TIMEOUT", 300)
+setting_api_hedge = getattr(settings, "PONDDY_AUTH_API_HEDGE", False)
+setting_api_hedge_percentile = getattr(settings, "PONDDY_AUTH_API_HEDGE_PERCENTILE", 95)
+setting_api_hedge_delay = getattr(settings, "PONDDY_AUTH_API_HEDGE_DELAY", 0.05)
+setting_api_retries = getattr(settings, "PONDDY_AUTH_API_RETRIES", 0)
+setting_api_retry_backoff = getattr(settings, "PONDDY_AUTH_API_RETRY_BACKOFF", 0.1)
+setting_api_retry_max_backoff = getattr(settings, "PONDDY_AUTH_API_RETRY_MAX_BACKOFF", 2)
+setting_api_retry_budget_ratio = getattr(settings, "PONDDY_AUTH_API_RETRY_BUDGET_RATIO", 0.1)
+setting_api_retry_budget_capacity = getattr(settings, "PONDDY_AUTH_API_RETRY_BUDGET_CAPACITY", 10)
 
+IDEMPOTENT_METHODS = frozenset(["DELETE", "GET", "HEAD", "OPTIONS", "PUT", "TRACE"])
+RETRY_STATUSES = frozenset([502, 503, 504])
+RETRY_ERRORS = (RequestConnectionError, Timeout)
+# The hedge delay follows the percentile once this many latencies are known
+HEDGE_MIN_SAMPLES = 20
+HEDGE_SAMPLES = 200
 
-class APIClient(Session):
-    def refresh_api_header(self) -> None:
-        self.status = timezone.now().timestamp()
-        self.payload = {
+
+class FanOutResult(typing.NamedTuple):
+    position: int
+    response: typing.Optional[Response]
+    error: typing.Optional[BaseException]
+
+
+class RetryBudget:
+    """A token bucket bounding the retries and the hedged requests to a share of the requests.
+
+    Every request deposits ``ratio`` token up to ``capacity``, every extra attempt withdraws one,
+    so when a downstream fails the extra load stops at ``ratio`` of the traffic.
+    """
+
+    def __init__(self, ratio: float, capacity: float):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+default_retry_budget = RetryBudget(
+    setting_api_retry_budget_ratio, setting_api_retry_budget_capacity
+)
+
+
+def is_replayable(
+    args: typing.Sequence[typing.Any], kwargs: typing.Mapping[str, typing.Any]
+) -> bool:
+    """Tell if the body of the ``Session.request`` arguments can be sent again.
+
+    A generator or a file is consumed by the first attempt, a retry would send it empty.
+    """
+    # ``params, data, headers, cookies, files`` follow ``method, url`` positionally
+    data = kwargs.get("data", args[1] if len(args) > 1 else None)
+    files = kwargs.get("files", args[4] if len(args) > 4 else None)
+    return files is None and (data is None or isinstance(data, (str, bytes, dict, list, tuple)))
+
+
+def close_response(future: "Future[Response]") -> None:
+    # The losing attempt gives its connection back to the pool
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class APIHeaderMixin:
+    """Sign the SSO token of the API and keep it in ``self.headers``."""
+
+    headers: typing.MutableMapping[str, typing.Any]
+
+    def set_up_api_credentials(
+        self,
+        payload_patch: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        app_name: typing.Optional[str] = None,
+        api_client_id: typing.Optional[str] = None,
+        api_secret: typing.Optional[str] = None,
+        api_token_prefix: typing.Optional[str] = None,
+        api_key_id: typing.Optional[str] = None,
+        api_token_lifetime: typing.Optional[float] = None,
+        api_token_refresh_margin: typing.Optional[float] = None,
+    ) -> None:
+        self.app_name = app_name or setting_app_name
+        self.api_client_id = api_client_id or setting_api_client_id
+        self.api_secret = api_secret or setting_api_secret
+        self.api_token_prefix = api_token_prefix or setting_api_token_prefix
+        self.api_key_id = api_key_id or setting_api_key_id
+        self.api_token_lifetime = api_token_lifetime or setting_api_token_lifetime
+        self.api_token_refresh_margin = (
+            setting_api_token_refresh_margin
+            if api_token_refresh_margin is None
+            else api_token_refresh_margin
+        )
+
+        self.payload_patch = payload_patch or {}
+        self.refresh_api_header()
+
+    def build_api_payload(self, status: float) -> typing.Dict[str, typing.Any]:
+        payload: typing.Dict[str, typing.Any] = {
             "api": self.api_client_id,
             "app": self.app_name,
-            "status": str(self.status),
+            "status": str(status),
         }
-        self.payload.update(self.payload_patch)
+        if self.api_token_lifetime:
+            payload["exp"] = int(status + self.api_token_lifetime)
+        payload.update(self.payload_patch)
+        return payload
+
+    def sign_api_header(
+        self, payload: typing.Dict[str, typing.Any]
+    ) -> typing.Dict[str, typing.Any]:
         token = f"{self.api_token_prefix} ".encode("utf-8") + jwt.encode(
-            self.payload, self.api_secret
+            payload,
+            self.api_secret,
+            headers={"kid": self.api_key_id} if self.api_key_id else None,
         ).encode("utf-8")
 
-        headers = {
+        return {
             "API": self.api_client_id,
             "APP": self.app_name,
             "Authorization": token,
-            "status": str(self.status),
+            "status": payload["status"],
         }
 
-        self.headers.update(headers)
+    def refresh_api_header(self) -> None:
+        self.status = timezone.now().timestamp()
+        self.payload = self.build_api_payload(self.status)
+        self.expires_at: typing.Optional[float] = None
+        if self.api_token_lifetime:
+            self.expires_at = self.status + self.api_token_lifetime
+        self.headers.update(self.sign_api_header(self.payload))
+
+    def api_header_expiring(self) -> bool:
+        if self.expires_at is None or not self.api_token_lifetime:
+            return False
+        margin = min(self.api_token_refresh_margin, self.api_token_lifetime / 2)
+        return timezone.now().timestamp() >= self.expires_at - margin
+
+
+class APIClient(APIHeaderMixin, Session):
+    last_used_at: float = 0
+    # Declared before the methods assigning them, ``__init__`` comes last in this class
+    _hedge_executor: typing.Optional[ThreadPoolExecutor]
+    _hedge_slots: typing.Optional[threading.BoundedSemaphore]
+    _hedge_pid: typing.Optional[int]
+
+    # The arguments go to ``Session.request`` as they are, its typed signature is not repeated
+    def request(  # type: ignore[override]
+        self, method: str, url: str, *args: typing.Any, **kwargs: typing.Any
+    ) -> Response:
+        self.last_used_at = time.monotonic()
+        if self.api_header_expiring():
+            with self._refresh_lock:
+                # Another thread may have signed the new token while this one waited
+                if self.api_header_expiring():
+                    self.refresh_api_header()
+        if self.can_hedge_or_retry(method, args, kwargs):
+            self.retry_budget.deposit()
+            return self.request_with_retries(method, url, *args, **kwargs)
+        return super().request(method, url, *args, **kwargs)
+
+    def can_hedge_or_retry(
+        self,
+        method: str,
+        args: typing.Sequence[typing.Any],
+        kwargs: typing.Mapping[str, typing.Any],
+    ) -> bool:
+        if not (self.hedge or self.retries) or method.upper() not in IDEMPOTENT_METHODS:
+            return False
+        return is_replayable(args, kwargs)
+
+    def sign_attempt(
+        self, request_kwargs: typing.Mapping[str, typing.Any]
+    ) -> typing.Dict[str, typing.Any]:
+        """Return ``request_kwargs`` with the headers of a new token, ``headers`` is left as is.
+
+        The client is shared by threads, the token of one attempt is passed with its request.
+        """
+        header = self.sign_api_header(self.build_api_payload(timezone.now().timestamp()))
+        headers = dict(request_kwargs.get("headers") or {}, **header)
+        return dict(request_kwargs, headers=headers)
+
+    def get_retry_backoff(self, attempt: int) -> float:
+        # Full jitter, the retries of many clients do not land at once
+        return random.uniform(0, min(self.retry_max_backoff, self.retry_backoff * 2**attempt))
+
+    def request_with_retries(
+        self, method: str, url: str, *args: typing.Any, **kwargs: typing.Any
+    ) -> Response:
+        """Retry the failed connections and ``RETRY_STATUSES`` while the retry budget allows."""
+        attempt = 0
+        while True:
+            try:
+                response = self.request_hedged(method, url, *args, **kwargs)
+            except RETRY_ERRORS:
+                if not self.can_retry(attempt):
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or not self.can_retry(attempt):
+                    return response
+                response.close()
+            attempt += 1
+            time.sleep(self.get_retry_backoff(attempt))
+            kwargs = self.sign_attempt(kwargs)
+
+    def can_retry(self, attempt: int) -> bool:
+        return attempt < self.retries and self.retry_budget.withdraw()
+
+    def record_latency(self, started: float) -> None:
+        with self._latencies_lock:
+            self._latencies.append(time.perf_counter() - started)
+
+    def get_hedge_delay(self) -> float:
+        with self._latencies_lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return self.hedge_delay
+        index = round(self.hedge_percentile / 100 * (len(latencies) - 1))
+        return max(self.hedge_delay, latencies[index])
+
+    def get_hedge_executor(self) -> ThreadPoolExecutor:
+        pid = os.getpid()
+        if self._hedge_executor is None or self._hedge_pid != pid:
+            with self._refresh_lock:
+                if self._hedge_executor is None or self._hedge_pid != pid:
+                    max_workers = setting_api_max_in_flight * 2
+                    self._hedge_executor = ThreadPoolExecutor(
+                        max_workers=max_workers, thread_name_prefix="ponddy_auth_hedge"
+                    )
+                    self._hedge_slots = threading.BoundedSemaphore(max_workers)
+                    self._hedge_pid = pid
+        return self._hedge_executor
+
+    def close(self) -> None:
+        super().close()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+            self._hedge_executor = None
+
+    def submit_attempt(
+        self, function: typing.Callable[..., Response], *args: typing.Any, **kwargs: typing.Any
+    ) -> typing.Optional["Future[Response]"]:
+        """Run ``function`` in the hedge pool, or return ``None`` when every worker is busy.
+
+        An attempt holds a slot until it ends, so an attempt never waits in the queue of the pool
+        and the threads of the hung attempts are bounded by the size of the pool.
+        """
+        executor = self.get_hedge_executor()
+        slots = typing.cast(threading.BoundedSemaphore, self._hedge_slots)
+        if not slots.acquire(blocking=False):
+            return None
+        try:
+            future = executor.submit(function, *args, **kwargs)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda future: slots.release())
+        return future
+
+    def run_attempt(
+        self, method: str, url: str, *args: typing.Any, **kwargs: typing.Any
+    ) -> Response:
+        started = time.perf_counter()
+        try:
+            return Session.request(self, method, url, *args, **kwargs)
+        finally:
+            self.record_latency(started)
+
+    def request_hedged(
+        self, method: str, url: str, *args: typing.Any, **kwargs: typing.Any
+    ) -> Response:
+        """Send a second request when the first one is slower than the hedge delay.
+
+        Both requests run in the hedge pool, the first one is sent on the calling thread without a
+        hedge when the pool is full. The first response wins, the other one is closed when it
+        arrives. The hedge carries its own token, the headers of the client are left as they are.
+        """
+        if not self.hedge:
+            return super().request(method, url, *args, **kwargs)
+        primary = self.submit_attempt(self.run_attempt, method, url, *args, **kwargs)
+        if primary is None:
+            return super().request(method, url, *args, **kwargs)
+        try:
+            return primary.result(timeout=self.get_hedge_delay())
+        except FutureTimeoutError:
+            pass
+        hedge = None
+        if self.retry_budget.withdraw():
+            hedge_kwargs = self.sign_attempt(kwargs)
+            hedge = self.submit_attempt(Session.request, self, method, url, *args, **hedge_kwargs)
+        if hedge is None:
+            return primary.result()
+        pending = {primary, hedge}
+        error: typing.Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending | (done - {future}):
+                        other.add_done_callback(close_response)
+                    return future.result()
+                error = future.exception()
+        raise typing.cast(BaseException, error)
+
+    def mount_pool(self, pool_size: int) -> None:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def mount_host_pools(self, host_pool_sizes: typing.Mapping[str, int]) -> None:
+        """Give each URL prefix of ``host_pool_sizes``, e.g. ``https://api.some.app``, a pool."""
+        for prefix, pool_size in host_pool_sizes.items():
+            self.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def map(
+        self,
+        requests: typing.Iterable[typing.Mapping[str, typing.Any]],
+        max_in_flight: typing.Optional[int] = None,
+        timeout: typing.Optional[typing.Union[float, typing.Tuple[float, float]]] = None,
+    ) -> typing.Iterator[FanOutResult]:
+        """Send the signed ``requests`` through a thread pool and yield them as they complete.
+
+        Each item holds the keyword arguments of ``request``, e.g. ``{"method": "GET", "url": u}``.
+        At most ``max_in_flight`` requests run at once over the connection pool of the client,
+        size it with ``pool_size``. The items are read lazily, failures are yielded as ``error``
+        instead of being raised. ``timeout`` is the default ``requests`` timeout of every request
+        and its deadline, a request still running after ``timeout`` seconds (the sum of a
+        ``(connect, read)`` pair) is yielded as a ``Timeout`` error and its response is dropped.
+        Its thread is only reused once it ends, the next items wait for it before being sent.
+        """
+        max_in_flight = max_in_flight or setting_api_max_in_flight
+        deadline = sum(timeout) if isinstance(timeout, tuple) else timeout
+        items = enumerate(requests)
+        futures: typing.Dict["Future[Response]", typing.Tuple[int, float]] = {}
+        # Timed out requests still hold their worker, nothing is submitted until one is free so
+        # that a request never waits in the queue of the executor while its deadline runs
+        abandoned: typing.Set["Future[Response]"] = set()
+        exhausted = False
+        executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+        def submit() -> bool:
+            nonlocal exhausted
+            if exhausted or len(futures) + len(abandoned) >= max_in_flight:
+                return False
+            item = next(items, None)
+            if item is None:
+                exhausted = True
+                return False
+            position, request = item
+            kwargs = dict(request)
+            if timeout is not None:
+                kwargs.setdefault("timeout", timeout)
+            expires_at = time.monotonic() + deadline if deadline is not None else float("inf")
+            futures[executor.submit(self.request, **kwargs)] = (position, expires_at)
+            return True
+
+        try:
+            while submit():
+                pass
+            while futures or (abandoned and not exhausted):
+                wait_timeout = None
+                if deadline is not None and futures:
+                    next_expiry = min(expires_at for _, expires_at in futures.values())
+                    wait_timeout = max(0.0, next_expiry - time.monotonic())
+                done, _ = wait(
+                    set(futures) | abandoned, timeout=wait_timeout, return_when=FIRST_COMPLETED
+                )
+                now = time.monotonic()
+                for future in done:
+                    if future in abandoned:
+                        abandoned.discard(future)
+                        continue
+                    position, _ = futures.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        yield FanOutResult(position=position, response=future.result(), error=None)
+                    else:
+                        yield FanOutResult(position=position, response=None, error=error)
+                for future, (position, expires_at) in list(futures.items()):
+                    if expires_at > now:
+                        continue
+                    del futures[future]
+                    abandoned.add(future)
+                    future.add_done_callback(close_response)
+                    yield FanOutResult(
+                        position=position, response=None, error=Timeout("Deadline exceeded")
+                    )
+                while submit():
+                    pass
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def __init__(
         self,
@@ -56,12 +458,140 @@ class APIClient(Session):
         api_client_id: typing.Optional[str] = None,
         api_secret: typing.Optional[str] = None,
         api_token_prefix: typing.Optional[str] = None,
+        api_key_id: typing.Optional[str] = None,
+        api_token_lifetime: typing.Optional[float] = None,
+        api_token_refresh_margin: typing.Optional[float] = None,
+        hedge: typing.Optional[bool] = None,
+        hedge_percentile: typing.Optional[float] = None,
+        hedge_delay: typing.Optional[float] = None,
+        retries: typing.Optional[int] = None,
+        retry_backoff: typing.Optional[float] = None,
+        retry_max_backoff: typing.Optional[float] = None,
+        retry_budget: typing.Optional[RetryBudget] = None,
+        pool_size: typing.Optional[int] = None,
     ):
         super().__init__()
-        self.app_name = app_name or setting_app_name
-        self.api_client_id = api_client_id or setting_api_client_id
-        self.api_secret = api_secret or setting_api_secret
-        self.api_token_prefix = api_token_prefix or setting_api_token_prefix
+        if pool_size is not None:
+            self.mount_pool(pool_size)
+        self._refresh_lock = threading.Lock()
+        self.hedge = setting_api_hedge if hedge is None else hedge
+        self.hedge_percentile = (
+            setting_api_hedge_percentile if hedge_percentile is None else hedge_percentile
+        )
+        self.hedge_delay = setting_api_hedge_delay if hedge_delay is None else hedge_delay
+        self.retries = setting_api_retries if retries is None else retries
+        self.retry_backoff = setting_api_retry_backoff if retry_backoff is None else retry_backoff
+        self.retry_max_backoff = (
+            setting_api_retry_max_backoff if retry_max_backoff is None else retry_max_backoff
+        )
+        self.retry_budget = retry_budget or default_retry_budget
+        self._latencies: typing.Deque[float] = deque(maxlen=HEDGE_SAMPLES)
+        self._latencies_lock = threading.Lock()
+        self._hedge_executor = None
+        self._hedge_slots = None
+        self._hedge_pid = None
+        self.set_up_api_credentials(
+            payload_patch=payload_patch,
+            app_name=app_name,
+            api_client_id=api_client_id,
+            api_secret=api_secret,
+            api_token_prefix=api_token_prefix,
+            api_key_id=api_key_id,
+            api_token_lifetime=api_token_lifetime,
+            api_token_refresh_margin=api_token_refresh_margin,
+        )
 
-        self.payload_patch = payload_patch or {}
-        self.refresh_api_header()
+
+class APIClientRegistry:
+    """Share one pooled ``APIClient`` per credentials and ``payload_patch`` in the process.
+
+    The clients are thread-safe to share, their cookies are never kept. A client not used for
+    ``idle_timeout`` seconds is closed and dropped, the next ``get`` builds a new one, and a
+    forked child drops the clients of its parent without closing their sockets.
+    """
+
+    def __init__(
+        self,
+        pool_size: typing.Optional[int] = None,
+        host_pool_sizes: typing.Optional[typing.Mapping[str, int]] = None,
+        idle_timeout: typing.Optional[float] = None,
+        timer: typing.Callable[[], float] = time.monotonic,
+    ):
+        self.pool_size = setting_api_client_pool_size if pool_size is None else pool_size
+        self.host_pool_sizes = (
+            setting_api_client_host_pool_sizes if host_pool_sizes is None else host_pool_sizes
+        )
+        self.idle_timeout = (
+            setting_api_client_idle_timeout if idle_timeout is None else idle_timeout
+        )
+        self.timer = timer
+        self._clients: typing.Dict[typing.Tuple[typing.Any, ...], APIClient] = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+    def get_key(
+        self, payload_patch: typing.Optional[typing.Dict[str, typing.Any]], **kwargs: typing.Any
+    ) -> typing.Tuple[typing.Any, ...]:
+        return (
+            kwargs.get("app_name") or setting_app_name,
+            kwargs.get("api_client_id") or setting_api_client_id,
+            kwargs.get("api_secret") or setting_api_secret,
+            json.dumps(payload_patch or {}, sort_keys=True, default=str),
+            tuple(sorted(kwargs.items())),
+        )
+
+    def build(
+        self, payload_patch: typing.Optional[typing.Dict[str, typing.Any]], **kwargs: typing.Any
+    ) -> APIClient:
+        client = APIClient(payload_patch=payload_patch, pool_size=self.pool_size, **kwargs)
+        disable_cookies(client)
+        client.mount_host_pools(self.host_pool_sizes)
+        return client
+
+    def get(
+        self,
+        payload_patch: typing.Optional[typing.Dict[str, typing.Any]] = None,
+        **kwargs: typing.Any,
+    ) -> APIClient:
+        """Return the shared client, the keyword arguments are the ones of ``APIClient``."""
+        key = self.get_key(payload_patch, **kwargs)
+        now = self.timer()
+        with self._lock:
+            if self._pid != os.getpid():
+                # The sockets are shared with the parent, leave them to it
+                self._clients = {}
+                self._pid = os.getpid()
+            if now >= self._next_sweep:
+                self.evict_idle(now)
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = self.build(payload_patch, **kwargs)
+            client.last_used_at = now
+        return client
+
+    def evict_idle(self, now: float) -> None:
+        self._next_sweep = now + self.idle_timeout / 2
+        for key, client in list(self._clients.items()):
+            if now - client.last_used_at >= self.idle_timeout:
+                del self._clients[key]
+                client.close()
+
+    def clear(self) -> None:
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+api_clients = APIClientRegistry()
+
+
+def get_api_client(
+    payload_patch: typing.Optional[typing.Dict[str, typing.Any]] = None, **kwargs: typing.Any
+) -> APIClient:
+    """Return the process-wide pooled ``APIClient`` of the credentials and ``payload_patch``."""
+    return api_clients.get(payload_patch, **kwargs)
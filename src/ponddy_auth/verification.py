@@ -0,0 +1,106 @@
+import typing
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from jose import jws, jwt
+from jose.exceptions import ExpiredSignatureError, JWSError, JWTError
+from rest_framework.exceptions import AuthenticationFailed
+
+VERIFICATION_MODE_REMOTE = "remote"
+VERIFICATION_MODE_LOCAL = "local"
+VERIFICATION_MODE_HYBRID = "hybrid"
+
+VERIFICATION_MODE = getattr(settings, "PONDDY_AUTH_VERIFICATION_MODE", VERIFICATION_MODE_REMOTE)
+JWT_KEYS: typing.Dict[str, typing.Mapping[str, typing.Any]] = getattr(
+    settings, "PONDDY_AUTH_JWT_KEYS", {}
+)
+JWT_ALGORITHMS = getattr(settings, "PONDDY_AUTH_JWT_ALGORITHMS", ["HS256"])
+JWT_LEEWAY = getattr(settings, "PONDDY_AUTH_JWT_LEEWAY", 0)
+JWT_REQUIRE_EXP = getattr(settings, "PONDDY_AUTH_JWT_REQUIRE_EXP", True)
+
+
+class UnverifiableToken(AuthenticationFailed):
+    """None of the configured keys can verify the signature of the token."""
+
+    default_detail = "Token signature cannot be verified."
+    default_code = "unverifiable_token"
+
+
+def get_raw_token(authorization: typing.Union[bytes, str]) -> str:
+    if isinstance(authorization, bytes):
+        authorization = authorization.decode("utf-8", "replace")
+    parts = authorization.split()
+    if len(parts) != 2:
+        raise AuthenticationFailed("Invalid token header")
+    return parts[1]
+
+
+def get_candidate_keys(
+    raw_token: str, keys: typing.Dict[str, typing.Mapping[str, typing.Any]]
+) -> typing.List[typing.Mapping[str, typing.Any]]:
+    try:
+        kid = jwt.get_unverified_header(raw_token).get("kid")
+    except JWTError:
+        raise AuthenticationFailed("Invalid token")
+    for entry in keys.values():
+        if not isinstance(entry, typing.Mapping) or "key" not in entry or "api" not in entry:
+            raise ImproperlyConfigured(
+                'Every PONDDY_AUTH_JWT_KEYS entry needs the "key" and the "api" it signs for'
+            )
+    if kid is None:
+        # Tokens signed without a key id are tried against every key, which covers rotation
+        return list(keys.values())
+    if kid not in keys:
+        raise UnverifiableToken("Unknown key id")
+    return [keys[kid]]
+
+
+def get_allowed_apis(entry: typing.Mapping[str, typing.Any]) -> typing.FrozenSet[str]:
+    apis = entry["api"]
+    if isinstance(apis, str):
+        apis = [apis]
+    return frozenset(str(api) for api in apis)
+
+
+def verify_claims(
+    payload: typing.Dict[str, typing.Any], headers: typing.Dict[str, typing.Any]
+) -> None:
+    if "api" not in payload:
+        raise AuthenticationFailed("Cannot found API info in the payload")
+    for claim in ("api", "app"):
+        header = headers.get(claim)
+        if header is not None and claim in payload and str(payload[claim]) != str(header):
+            raise AuthenticationFailed(f"The {claim} claim does not match the {claim} header")
+
+
+def verify_token(
+    headers: typing.Dict[str, typing.Any],
+    keys: typing.Optional[typing.Dict[str, typing.Mapping[str, typing.Any]]] = None,
+    algorithms: typing.Optional[typing.List[str]] = None,
+) -> typing.Dict[str, typing.Any]:
+    """Verify the token of the validation ``headers`` without calling ``AUTH_TOKEN_VALID_URL``."""
+    raw_token = get_raw_token(headers["authorization"])
+    algorithms = algorithms or JWT_ALGORITHMS
+    for entry in get_candidate_keys(raw_token, JWT_KEYS if keys is None else keys):
+        try:
+            jws.verify(raw_token, entry["key"], algorithms)
+        except JWSError:
+            continue
+        break
+    else:
+        raise UnverifiableToken()
+
+    options = {"verify_signature": False, "leeway": JWT_LEEWAY, "require_exp": JWT_REQUIRE_EXP}
+    try:
+        payload: typing.Dict[str, typing.Any] = jwt.decode(
+            raw_token, entry["key"], algorithms=algorithms, options=options
+        )
+    except ExpiredSignatureError:
+        raise AuthenticationFailed("Token expired")
+    except JWTError as e:
+        raise AuthenticationFailed(str(e))
+    verify_claims(payload, headers)
+    # A key only vouches for the API clients it belongs to, the api claim is chosen by the signer
+    if str(payload["api"]) not in get_allowed_apis(entry):
+        raise AuthenticationFailed("The key cannot sign for the API client")
+    return payload
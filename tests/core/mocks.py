@@ -1,5 +1,6 @@
 class MockAuthHTTPResponse:
-    def __init__(self, ok=True, content=""):
+    def __init__(self, ok=True, content="", status_code=None):
         self.ok = ok
         self.text = content
-        self.status_code = "Mock"
+        # The auth server answers 401 to the tokens it rejects
+        self.status_code = status_code or (200 if ok else 401)
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import sys
+
+import django
+import pytest
+
+# AsyncMock is new in Python 3.8, the async test methods in Django 3.1, httpx is the async extra
+if sys.version_info < (3, 8) or django.VERSION < (3, 1):
+    pytest.skip("The async tests need Python 3.8 and Django 3.1", allow_module_level=True)
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("asgiref")
+
+from unittest.mock import AsyncMock, patch  # noqa: E402
+
+from asgiref.sync import sync_to_async  # noqa: E402
+from django.test import TestCase  # noqa: E402
+from jose import jwt  # noqa: E402
+from rest_framework.exceptions import AuthenticationFailed  # noqa: E402
+
+from ponddy_auth.aio import AsyncAPIClient, AsyncSSOAuthentication  # noqa: E402
+
+from .tests import TestAPIMixin  # noqa: E402
+
+
+class AsyncSSOAuthenticationTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+
+    async def test_aauthenticate_returns_user_and_api_agent(self):
+        response = httpx.Response(200, text=json.dumps(self.get_payload()))
+        with patch("httpx.AsyncClient.get", AsyncMock(return_value=response)) as mock_auth:
+            user, payload = await AsyncSSOAuthentication().aauthenticate(self.get_sso_request())
+        mock_auth.assert_awaited_once()
+        self.assertEqual(payload, self.get_payload())
+        self.assertEqual(user.email, self.EMAIL)
+        # The permission check of a view runs in a thread, it may load the permission index
+        assert await sync_to_async(getattr(user, "_api_agent").has_perm)(self._permission)
+
+    async def test_aauthenticate_rejects_invalid_token_and_timeout(self):
+        response = httpx.Response(401, text="")
+        with patch("httpx.AsyncClient.get", AsyncMock(return_value=response)):
+            with self.assertRaises(AuthenticationFailed):
+                await AsyncSSOAuthentication().aauthenticate(self.get_sso_request())
+        with patch("httpx.AsyncClient.get", AsyncMock(side_effect=httpx.ReadTimeout("timeout"))):
+            with self.assertRaisesMessage(AuthenticationFailed, "Auth server timeout"):
+                await AsyncSSOAuthentication().aauthenticate(self.get_sso_request())
+
+
+class AsyncAPIClientTest(TestAPIMixin, TestCase):
+    async def test_requests_are_signed_like_api_client(self):
+        received = []
+
+        def handler(request):
+            received.append(request.headers)
+            return httpx.Response(200)
+
+        async with AsyncAPIClient(
+            payload_patch={"email": self.EMAIL},
+            app_name=self.APP,
+            api_client_id=self.API,
+            api_secret=self.SECRET,
+            transport=httpx.MockTransport(handler),
+        ) as client:
+            await client.get("http://app.local/users/")
+        self.assertEqual(received[0]["api"], self.API)
+        self.assertEqual(received[0]["app"], self.APP)
+        token = received[0]["authorization"].split()[1]
+        self.assertEqual(jwt.decode(token, self.SECRET), client.payload)
+        self.assertEqual(client.payload["email"], self.EMAIL)
+
+    async def test_concurrency_is_limited_per_host(self):
+        in_flight = {"app.local": 0, "other.local": 0}
+        peaks = dict(in_flight)
+
+        async def handler(request):
+            host = request.url.host
+            in_flight[host] += 1
+            peaks[host] = max(peaks[host], in_flight[host])
+            await asyncio.sleep(0.01)
+            in_flight[host] -= 1
+            return httpx.Response(200)
+
+        async with AsyncAPIClient(
+            app_name=self.APP,
+            api_client_id=self.API,
+            api_secret=self.SECRET,
+            max_connections_per_host=2,
+            transport=httpx.MockTransport(handler),
+        ) as client:
+            await asyncio.gather(
+                *[client.get(f"http://{host}/") for host in in_flight for _ in range(6)]
+            )
+        self.assertEqual(peaks, {"app.local": 2, "other.local": 2})
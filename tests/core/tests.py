@@ -1,16 +1,56 @@
+import gc
 import json
-from unittest.mock import patch
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import MagicMock, patch
 from uuid import uuid4
 
+import requests
 from django.conf import settings
-from django.contrib.auth.models import Group, Permission
+from django.contrib.auth.models import AnonymousUser, Group, Permission, User
+from django.core.cache import caches
+from django.core.management import call_command
 from django.http import HttpRequest
 from django.shortcuts import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from jose import jwt
 from ponddy_api_test_client import SSOClient
+from rest_framework.exceptions import AuthenticationFailed
 
-from ponddy_auth.authentication import SSOAuthentication
+from ponddy_auth import agents, transport
+from ponddy_auth.agents import api_agent_cache, unknown_api_agent_cache
+from ponddy_auth.authentication import (
+    AuthServerError,
+    AuthServerUnavailable,
+    InvalidToken,
+    SSOAuthentication,
+    attach_permission_functions,
+)
+from ponddy_auth.batch import authenticate_batch
+from ponddy_auth.breaker import CircuitBreaker
+from ponddy_auth.cache import DjangoCache, TTLCache
+from ponddy_auth.concurrency import Refresher, SingleFlight
+from ponddy_auth.metrics import (
+    AUTHENTICATIONS,
+    PERMISSION_CHECKS,
+    PHASE_SECONDS,
+    InMemoryExporter,
+    get_metrics_exporter,
+    set_metrics_exporter,
+)
+from ponddy_auth.permissions import SSODjangoModelPermissions
+from ponddy_auth.testing import ValidationServer, run_load
+from ponddy_auth.transport import get_validation_session, get_validation_timeout
+from ponddy_auth.verification import (
+    VERIFICATION_MODE_HYBRID,
+    VERIFICATION_MODE_LOCAL,
+    UnverifiableToken,
+)
 
 from .mocks import MockAuthHTTPResponse
 
@@ -42,13 +82,18 @@ class TestAPIMixin:
             token="{prefix} {token}".format(prefix=SSO_AUTH_HEADER_PREFIX, token=self.token)
         )
 
+    def get_sso_request(self):
+        request = HttpRequest()
+        request.META = {"HTTP_AUTHORIZATION": self.sso_client.token}
+        return request
+
 
 class APIClientTest(TestAPIMixin, TestCase):
     def setUp(self):
         super().setUp()
         self.set_up_api()
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_api_client_request_authenticated(self, mock_auth):
         from ponddy_auth.utils import APIClient
 
@@ -70,13 +115,126 @@ class APIClientTest(TestAPIMixin, TestCase):
         assert api_agent.has_perm(self._permission)
         assert api_agent.has_perms([self._permission])
 
+    def test_registry_shares_pooled_clients_by_credentials(self):
+        from ponddy_auth.utils import APIClientRegistry
+
+        now = [0.0]
+        registry = APIClientRegistry(
+            pool_size=4,
+            host_pool_sizes={"https://api.some.app": 16},
+            idle_timeout=60,
+            timer=lambda: now[0],
+        )
+        self.addCleanup(registry.clear)
+        credentials = {"app_name": self.APP, "api_client_id": self.API, "api_secret": self.SECRET}
+        client = registry.get(**credentials)
+        self.assertIs(registry.get(payload_patch={}, **credentials), client)
+        user_client = registry.get(payload_patch={"email": self.EMAIL}, **credentials)
+        self.assertIsNot(user_client, client)
+        self.assertEqual(user_client.payload["email"], self.EMAIL)
+        self.assertEqual(client.get_adapter("https://other.app")._pool_maxsize, 4)
+        self.assertEqual(client.get_adapter("https://api.some.app/items")._pool_maxsize, 16)
+
+        now[0] = 45
+        registry.get(**credentials)
+        now[0] = 90
+        self.assertIs(registry.get(**credentials), client)
+        self.assertEqual(len(registry), 1)
+
+        # A forked child builds its own clients
+        with patch("ponddy_auth.utils.os.getpid", return_value=-1):
+            self.assertIsNot(registry.get(**credentials), client)
+
+    def test_retries_are_signed_again_and_bounded_by_the_budget(self):
+        from ponddy_auth.utils import APIClient, RetryBudget
+
+        client = APIClient(
+            app_name=self.APP,
+            api_client_id=self.API,
+            api_secret=self.SECRET,
+            retries=3,
+            retry_backoff=0,
+            retry_budget=RetryBudget(ratio=0, capacity=1),
+        )
+        tokens = []
+
+        def send(*args, **kwargs):
+            tokens.append((kwargs.get("headers") or client.headers)["Authorization"])
+            return MagicMock(status_code=503)
+
+        with patch("ponddy_auth.utils.Session.request", side_effect=send):
+            self.assertEqual(client.get("https://some.app").status_code, 503)
+            self.assertEqual(client.post("https://some.app").status_code, 503)
+            # A generator body cannot be sent again
+            client.retry_budget = RetryBudget(ratio=0, capacity=1)
+            client.put("https://some.app", data=iter([b"body"]))
+        self.assertEqual(len(tokens), 4)
+        self.assertNotEqual(tokens[0], tokens[1])
+
+    def test_slow_request_is_hedged(self):
+        from ponddy_auth.utils import APIClient, RetryBudget
+
+        client = APIClient(
+            app_name=self.APP,
+            api_client_id=self.API,
+            api_secret=self.SECRET,
+            hedge=True,
+            hedge_delay=0.01,
+            retry_budget=RetryBudget(ratio=0, capacity=1),
+        )
+        self.addCleanup(client.close)
+        released = threading.Event()
+        slow, fast = MagicMock(status_code=200), MagicMock(status_code=200)
+        responses = iter([slow, fast])
+        tokens = []
+
+        def send(*args, **kwargs):
+            tokens.append((kwargs.get("headers") or client.headers)["Authorization"])
+            threads.append(threading.current_thread())
+            response = next(responses)
+            if response is slow:
+                released.wait(5)
+            return response
+
+        threads = []
+        with patch("ponddy_auth.utils.Session.request", side_effect=send):
+            self.assertIs(client.get("https://some.app"), fast)
+            released.set()
+            client.get_hedge_executor().shutdown(wait=True)
+        slow.close.assert_called_once_with()
+        self.assertNotEqual(tokens[0], tokens[1])
+        # The token of the hedge is not written to the headers shared by the threads
+        self.assertEqual(client.headers["Authorization"], tokens[0])
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_hedge_pool_is_bounded(self):
+        from ponddy_auth.utils import APIClient
+
+        client = APIClient(
+            app_name=self.APP, api_client_id=self.API, api_secret=self.SECRET, hedge=True
+        )
+        self.addCleanup(client.close)
+        client.get_hedge_executor()
+        client._hedge_slots = threading.BoundedSemaphore(1)
+        client._hedge_slots.acquire()
+        threads = []
+
+        def send(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return MagicMock(status_code=200)
+
+        # Every worker is busy, the request is sent on the calling thread without a hedge
+        with patch("ponddy_auth.utils.Session.request", side_effect=send):
+            client.get("https://some.app")
+        self.assertEqual(threads, [threading.current_thread()])
+
 
 class SSOAuthenticationTest(TestAPIMixin, TestCase):
     def setUp(self):
         super().setUp()
         self.set_up_api()
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_sso_auth_will_return_user_if_auth_valid_token(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
             content=json.dumps(self.get_payload())
@@ -98,7 +256,7 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
         assert api_agent.has_perm(self._permission)
         assert api_agent.has_perms([self._permission])
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_valid_sso_can_list_users(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
             content=json.dumps(self.get_payload())
@@ -106,7 +264,7 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
         resp = self.sso_client.get(reverse("user-list"))
         self.assertEqual(resp.status_code, 200)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_valid_sso_cannot_create_user(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
             content=json.dumps(self.get_payload())
@@ -117,19 +275,19 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
         self.assertEqual(resp.status_code, 403)
         self.assertNotEqual(resp.status_code, 200)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_invalid_sso_cannot_do_anything(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(ok=False, content=b"")
         resp = self.sso_client.get(reverse("user-list"))
         self.assertEqual(resp.status_code, 401)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_empty_authentication_token_will_not_raise_error(self, mock_auth):
         mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(ok=False, content=b"")
         resp = self.client.get(reverse("user-list"))
         self.assertEqual(resp.status_code, 403)
 
-    @patch("ponddy_auth.authentication.requests.get")
+    @patch("ponddy_auth.transport.Session.get")
     def test_token_group_not_exists(self, mock_auth):
         payload = self.get_payload()
         payload.update({"api": str(uuid4())})
@@ -138,3 +296,1012 @@ class SSOAuthenticationTest(TestAPIMixin, TestCase):
         )
         resp = self.sso_client.get(reverse("user-list"))
         self.assertEqual(resp.status_code, 401)
+
+
+class TokenCacheTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.cache = TTLCache(maxsize=2, ttl=60)
+        patcher = patch.object(SSOAuthentication, "token_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def authenticate(self):
+        return SSOAuthentication().authenticate(self.get_sso_request())
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_valid_token_is_validated_once(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        _, first = self.authenticate()
+        _, second = self.authenticate()
+        self.assertEqual(mock_auth.call_count, 1)
+        self.assertEqual(first, second)
+        stats = self.cache.stats()
+        self.assertEqual((stats.hits, stats.misses, stats.size), (1, 1, 1))
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_expired_token_is_not_cached(self, mock_auth):
+        payload = dict(self.get_payload(), exp=time.time() - 1)
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(payload)
+        )
+        self.authenticate()
+        self.authenticate()
+        self.assertEqual(mock_auth.call_count, 2)
+        self.assertEqual(len(self.cache), 0)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_hot_token_is_refreshed_ahead(self, mock_auth):
+        responses = [MockAuthHTTPResponse(content=json.dumps(self.get_payload()))] * 2
+        responses.append(MockAuthHTTPResponse(ok=False, content=b""))
+        mock_auth.side_effect = responses
+        now = [0.0]
+        self.cache.timer = lambda: now[0]
+        refresher = Refresher(max_workers=1)
+        self.addCleanup(refresher.shutdown)
+        with patch.multiple(SSOAuthentication, refresh_ahead=10, validation_refresher=refresher):
+            self.authenticate()
+            now[0] = 30
+            self.authenticate()
+            refresher.shutdown()
+            self.assertEqual(mock_auth.call_count, 1)
+
+            # Read shortly before it expires, the cached result is answered and refreshed
+            now[0] = 55
+            self.authenticate()
+            refresher.shutdown()
+            self.assertEqual(mock_auth.call_count, 2)
+            self.assertEqual(self.cache.get_with_ttl(list(self.cache._data)[0])[1], 60)
+
+            # The token revoked meanwhile is dropped by the refresh
+            now[0] = 110
+            self.authenticate()
+            refresher.shutdown()
+            self.assertEqual(mock_auth.call_count, 3)
+            self.assertEqual(len(self.cache), 0)
+        self.assertEqual(refresher.stats().submitted, 2)
+
+    def test_refreshers_are_reset_in_a_forked_child(self):
+        from ponddy_auth import concurrency
+
+        refresher = Refresher(max_workers=1)
+        refresher.submit("key", lambda: None)
+        self.addCleanup(refresher._executor.shutdown)
+        concurrency._reset_refreshers()
+        self.assertIsNone(refresher._executor)
+
+        # The hook does not keep the refreshers alive
+        reference = weakref.ref(refresher)
+        del refresher
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def test_cache_evicts_least_recently_used_and_expired_entries(self):
+        now = [0.0]
+        cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        now[0] = 11
+        self.assertIsNone(cache.get("c"))
+        stats = cache.stats()
+        self.assertEqual((stats.evictions, stats.expirations), (1, 1))
+
+
+class ValidationTransportTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+
+    def test_validation_session_is_shared_and_pooled(self):
+        session = get_validation_session()
+        self.assertIs(session, get_validation_session())
+        adapter = session.get_adapter(settings.AUTH_TOKEN_VALID_URL)
+        self.assertEqual(adapter._pool_maxsize, transport.VALIDATION_POOL_SIZE)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_validation_call_sets_timeout(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        SSOAuthentication().authenticate(self.get_sso_request())
+        self.assertEqual(mock_auth.call_args[1]["timeout"], get_validation_timeout())
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_validation_timeout_fails_authentication(self, mock_auth):
+        mock_auth.side_effect = requests.ReadTimeout("timeout")
+        with self.assertRaises(AuthenticationFailed):
+            SSOAuthentication().authenticate(self.get_sso_request())
+        with patch("ponddy_auth.authentication.VALIDATION_TIMEOUT_STATUS", 503):
+            with self.assertRaises(AuthServerUnavailable):
+                SSOAuthentication().authenticate(self.get_sso_request())
+
+
+class LocalVerificationTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        patcher = patch.object(SSOAuthentication, "verification_mode", VERIFICATION_MODE_LOCAL)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.other_api = str(uuid4())
+        keys = {
+            "old": {"key": "OLD", "api": [self.API]},
+            "new": {"key": self.SECRET, "api": [self.API]},
+            "other": {"key": "OTHER", "api": self.other_api},
+        }
+        patcher = patch("ponddy_auth.verification.JWT_KEYS", keys)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_client_request(self, **kwargs):
+        from ponddy_auth.utils import APIClient
+
+        options = {
+            "app_name": self.APP,
+            "api_client_id": self.API,
+            "api_secret": self.SECRET,
+            "api_token_lifetime": 300,
+        }
+        options.update(kwargs)
+        client = APIClient(**options)
+        request = HttpRequest()
+        request.META = {f"HTTP_{key.upper()}": val for key, val in client.headers.items()}
+        return request
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_signed_token_is_verified_without_upstream_call(self, mock_auth):
+        for api_key_id in ("new", None):
+            user, payload = SSOAuthentication().authenticate(
+                self.get_client_request(api_key_id=api_key_id)
+            )
+            self.assertEqual(payload["api"], self.API)
+            assert user.is_anonymous is True
+            assert getattr(user, "_api_agent").has_perm(self._permission)
+        mock_auth.assert_not_called()
+
+    def test_rejects_mismatched_claims_and_expired_tokens(self):
+        request = self.get_client_request()
+        request.META["HTTP_API"] = str(uuid4())
+        with self.assertRaises(AuthenticationFailed):
+            SSOAuthentication().authenticate(request)
+        request = self.get_client_request(payload_patch={"exp": int(time.time()) - 10})
+        with self.assertRaisesMessage(AuthenticationFailed, "Token expired"):
+            SSOAuthentication().authenticate(request)
+        with self.assertRaises(UnverifiableToken):
+            SSOAuthentication().authenticate(self.get_client_request(api_secret="UNKNOWN"))
+        request = self.get_client_request(api_token_lifetime=None)
+        with self.assertRaisesMessage(AuthenticationFailed, "exp"):
+            SSOAuthentication().authenticate(request)
+
+    def test_rejects_key_of_another_api_client(self):
+        # Signed with the key of the other client, claiming to be this one
+        for api_key_id in ("other", None):
+            request = self.get_client_request(api_secret="OTHER", api_key_id=api_key_id)
+            with self.assertRaisesMessage(AuthenticationFailed, "cannot sign for the API client"):
+                SSOAuthentication().authenticate(request)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_hybrid_mode_falls_back_to_upstream(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        with patch.object(SSOAuthentication, "verification_mode", VERIFICATION_MODE_HYBRID):
+            SSOAuthentication().authenticate(self.get_client_request())
+            mock_auth.assert_not_called()
+            SSOAuthentication().authenticate(self.get_client_request(api_secret="UNKNOWN"))
+            mock_auth.assert_called_once()
+
+
+class APIAgentCacheTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        patcher = patch.object(api_agent_cache, "maxsize", 16)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(api_agent_cache.clear)
+
+    def get_api_agent(self):
+        return SSOAuthentication().get_api_agent(self.get_payload())
+
+    def test_warm_api_agent_runs_no_query(self):
+        self.get_api_agent()
+        with self.assertNumQueries(0):
+            api_agent = self.get_api_agent()
+            assert api_agent.has_perm(self._permission)
+            assert api_agent.has_perms([self._permission])
+        self.assertEqual(api_agent.pk, self.api.pk)
+
+    def test_permission_changes_invalidate_api_agent(self):
+        add_user = Permission.objects.get(codename="add_user", content_type__app_label="auth")
+        assert not self.get_api_agent().has_perm("auth.add_user")
+        self.api.permissions.add(add_user)
+        assert self.get_api_agent().has_perm("auth.add_user")
+        add_user.group_set.remove(self.api)
+        assert not self.get_api_agent().has_perm("auth.add_user")
+        self.permission.group_set.clear()
+        assert not self.get_api_agent().has_perm(self._permission)
+
+    def test_deleted_group_invalidates_api_agent(self):
+        self.get_api_agent()
+        self.api.delete()
+        with self.assertRaisesMessage(AuthenticationFailed, "Group not exists"):
+            self.get_api_agent()
+
+
+class SingleFlightTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.flight = SingleFlight(timeout=5)
+        patcher = patch.object(SSOAuthentication, "validation_flight", self.flight)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def validate_concurrently(self, mock_auth, response, count=5):
+        release = threading.Event()
+
+        def get(*args, **kwargs):
+            release.wait(5)
+            return response
+
+        mock_auth.side_effect = get
+        headers = SSOAuthentication().get_validation_headers(
+            self.get_sso_request(), self.sso_client.token.encode("utf-8")
+        )
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [
+                executor.submit(SSOAuthentication().validate_token, headers) for _ in range(count)
+            ]
+            while self.flight.stats().waiters < count - 1:
+                time.sleep(0.001)
+            release.set()
+        return futures
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_concurrent_validations_share_one_upstream_call(self, mock_auth):
+        response = MockAuthHTTPResponse(content=json.dumps(self.get_payload()))
+        futures = self.validate_concurrently(mock_auth, response)
+        self.assertEqual(mock_auth.call_count, 1)
+        for future in futures:
+            self.assertEqual(future.result(), self.get_payload())
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_concurrent_validations_share_the_failure(self, mock_auth):
+        response = MockAuthHTTPResponse(ok=False, content=b"")
+        futures = self.validate_concurrently(mock_auth, response)
+        self.assertEqual(mock_auth.call_count, 1)
+        for future in futures:
+            self.assertRaises(AuthenticationFailed, future.result)
+
+    def test_waiter_falls_back_when_leader_hangs(self):
+        flight = SingleFlight(timeout=0.01)
+        release = threading.Event()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            leader = executor.submit(flight.do, "key", lambda: release.wait(5) and "leader")
+            while flight.stats().in_flight < 1:
+                time.sleep(0.001)
+            self.assertEqual(flight.do("key", lambda: "fallback"), "fallback")
+            release.set()
+            self.assertEqual(leader.result(), "leader")
+        self.assertEqual(flight.stats().fallbacks, 1)
+
+
+class NegativeCacheTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.rejected = TTLCache(maxsize=16, ttl=10)
+        for patcher in [
+            patch.object(SSOAuthentication, "rejected_token_cache", self.rejected),
+            patch.object(unknown_api_agent_cache, "maxsize", 16),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(unknown_api_agent_cache.clear)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_rejected_token_is_not_validated_again(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(ok=False, content=b"")
+        for _ in range(3):
+            with self.assertRaises(InvalidToken):
+                SSOAuthentication().authenticate(self.get_sso_request())
+        self.assertEqual(mock_auth.call_count, 1)
+        self.assertEqual(self.rejected.stats().hits, 2)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_upstream_error_is_not_cached(self, mock_auth):
+        # Throttled or timed out, the auth server did not reject the token
+        for status_code in (502, 408, 429, 400):
+            mock_auth.reset_mock()
+            mock_auth.return_value = MockAuthHTTPResponse(
+                ok=False, content=b"", status_code=status_code
+            )
+            for _ in range(2):
+                with self.assertRaises(AuthenticationFailed) as raised:
+                    SSOAuthentication().authenticate(self.get_sso_request())
+                self.assertNotIsInstance(raised.exception, InvalidToken)
+            self.assertEqual(mock_auth.call_count, 2)
+            self.assertEqual(len(self.rejected), 0)
+
+    def test_unknown_api_id_is_rejected_without_query(self):
+        api = str(uuid4())
+        payload = dict(self.get_payload(), api=api)
+        with self.assertRaises(AuthenticationFailed):
+            SSOAuthentication().get_api_agent(payload)
+        with self.assertNumQueries(0), self.assertRaises(AuthenticationFailed):
+            SSOAuthentication().get_api_agent(payload)
+        group = Group.objects.create(name=f"{API_AGENT_PREFIX}_{api}")
+        self.assertEqual(SSOAuthentication().get_api_agent(payload).pk, group.pk)
+
+
+class CircuitBreakerTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.now = [0.0]
+        self.breaker = CircuitBreaker(
+            minimum_calls=2, window_size=4, open_duration=10, timer=lambda: self.now[0]
+        )
+        self.changes = []
+        self.breaker.add_listener(lambda breaker, old, new: self.changes.append((old, new)))
+        patcher = patch.object(SSOAuthentication, "validation_breaker", self.breaker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_breaker_opens_probes_and_closes(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow_request())
+        self.now[0] = 10
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertEqual(
+            self.changes, [("closed", "open"), ("open", "half_open"), ("half_open", "closed")]
+        )
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_open_breaker_fails_fast(self, mock_auth):
+        mock_auth.side_effect = requests.ConnectionError("down")
+        for _ in range(2):
+            with self.assertRaises(AuthServerError):
+                SSOAuthentication().authenticate(self.get_sso_request())
+        with self.assertRaisesMessage(AuthServerError, "Auth server circuit is open"):
+            SSOAuthentication().authenticate(self.get_sso_request())
+        self.assertEqual(mock_auth.call_count, 2)
+        self.assertEqual(self.breaker.stats().rejected, 1)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_stale_result_is_served_while_breaker_is_open(self, mock_auth):
+        cache = TTLCache(maxsize=16, ttl=60, timer=lambda: self.now[0])
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        with patch.object(SSOAuthentication, "token_cache", cache), patch(
+            "ponddy_auth.authentication.STALE_IF_ERROR", 300
+        ):
+            SSOAuthentication().authenticate(self.get_sso_request())
+            mock_auth.side_effect = requests.ConnectionError("down")
+            self.now[0] = 100
+            for _ in range(2):
+                _, payload = SSOAuthentication().authenticate(self.get_sso_request())
+                self.assertEqual(payload, self.get_payload())
+            self.assertEqual(self.breaker.state, "open")
+            self.now[0] = 400
+            with self.assertRaises(AuthServerError):
+                SSOAuthentication().authenticate(self.get_sso_request())
+        self.assertEqual(mock_auth.call_count, 3)
+
+
+class BatchAuthenticationTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        User.objects.create(username=self.EMAIL, email=self.EMAIL)
+        self.invalid_token = "{prefix} invalid".format(prefix=SSO_AUTH_HEADER_PREFIX)
+        self.items = [
+            {"authorization": self.sso_client.token},
+            {"authorization": self.invalid_token},
+            {"authorization": self.sso_client.token},
+        ]
+
+    def assert_results(self, results):
+        self.assertEqual([result.payload for result in results[::2]], [self.get_payload()] * 2)
+        for result in results[::2]:
+            self.assertEqual(result.user.email, self.EMAIL)
+            assert getattr(result.user, "_api_agent").has_perm(self._permission)
+        self.assertIsInstance(results[1].error, InvalidToken)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_batch_is_deduplicated_and_ordered(self, mock_auth):
+        def get(url, headers, **kwargs):
+            ok = headers["authorization"] == self.sso_client.token.encode("utf-8")
+            return MockAuthHTTPResponse(ok=ok, content=json.dumps(self.get_payload()))
+
+        mock_auth.side_effect = get
+        with self.assertNumQueries(2):
+            results = authenticate_batch(self.items)
+        self.assertEqual(mock_auth.call_count, 2)
+        self.assert_results(results)
+
+    @patch("ponddy_auth.transport.Session.post")
+    def test_batch_endpoint_validates_in_one_call(self, mock_post):
+        mock_post.return_value.ok = True
+        mock_post.return_value.json.return_value = {
+            "results": [{"status": 200, "payload": self.get_payload()}, {"status": 401}]
+        }
+        with patch("ponddy_auth.batch.AUTH_TOKEN_BATCH_VALID_URL", "http://localhost/batch"):
+            results = authenticate_batch(self.items)
+        mock_post.assert_called_once()
+        tokens = mock_post.call_args[1]["json"]["tokens"]
+        self.assertEqual(
+            [token["authorization"] for token in tokens],
+            [self.sso_client.token, self.invalid_token],
+        )
+        self.assert_results(results)
+
+    @patch("ponddy_auth.transport.Session.post")
+    def test_batch_throttled_answer_is_not_cached(self, mock_post):
+        rejected = TTLCache(maxsize=16, ttl=10)
+        mock_post.return_value.ok = True
+        mock_post.return_value.json.return_value = {
+            "results": [{"status": 200, "payload": self.get_payload()}, {"status": 429}]
+        }
+        with patch("ponddy_auth.batch.AUTH_TOKEN_BATCH_VALID_URL", "http://localhost/batch"):
+            with patch.object(SSOAuthentication, "rejected_token_cache", rejected):
+                results = authenticate_batch(self.items)
+        self.assertIsInstance(results[1].error, AuthServerError)
+        self.assertEqual(len(rejected), 0)
+
+    @patch("ponddy_auth.transport.Session.post")
+    def test_malformed_batch_answer_fails_every_token(self, mock_post):
+        mock_post.return_value.ok = True
+        for answer in [
+            ValueError("Not JSON"),
+            {"result": []},
+            {"results": [{"status": 200, "payload": self.get_payload()}]},
+            {"results": [{"payload": self.get_payload()}, {"status": 401}]},
+        ]:
+            if isinstance(answer, Exception):
+                mock_post.return_value.json.side_effect = answer
+            else:
+                mock_post.return_value.json.side_effect = None
+                mock_post.return_value.json.return_value = answer
+            with patch("ponddy_auth.batch.AUTH_TOKEN_BATCH_VALID_URL", "http://localhost/batch"):
+                results = authenticate_batch(self.items)
+            for result in results:
+                self.assertIsInstance(result.error, AuthServerError)
+
+
+class APIClientTokenLifetimeTest(TestAPIMixin, TestCase):
+    def get_client(self, now, **kwargs):
+        from ponddy_auth.utils import APIClient
+
+        with patch("ponddy_auth.utils.timezone.now", return_value=now):
+            return APIClient(
+                app_name=self.APP, api_client_id=self.API, api_secret=self.SECRET, **kwargs
+            )
+
+    @patch("ponddy_auth.utils.Session.send")
+    def test_token_is_signed_again_shortly_before_expiry(self, mock_send):
+        now = timezone.now()
+        client = self.get_client(now, api_token_lifetime=300)
+        token = client.headers["Authorization"]
+        self.assertEqual(
+            jwt.decode(token.split()[1], self.SECRET)["exp"], int(now.timestamp() + 300)
+        )
+        with patch("ponddy_auth.utils.timezone.now", return_value=now + timedelta(seconds=200)):
+            client.get("http://localhost")
+        self.assertEqual(client.headers["Authorization"], token)
+        with patch("ponddy_auth.utils.timezone.now", return_value=now + timedelta(seconds=280)):
+            client.get("http://localhost")
+        self.assertNotEqual(client.headers["Authorization"], token)
+        self.assertEqual(client.expires_at, now.timestamp() + 280 + 300)
+        self.assertEqual(mock_send.call_count, 2)
+
+    @patch("ponddy_auth.utils.Session.send")
+    def test_token_without_lifetime_is_never_signed_again(self, mock_send):
+        client = self.get_client(timezone.now())
+        token = client.headers["Authorization"]
+        client.get("http://localhost")
+        self.assertEqual(client.headers["Authorization"], token)
+        self.assertNotIn("exp", client.payload)
+
+
+class APIClientMapTest(TestAPIMixin, TestCase):
+    @patch("ponddy_auth.utils.Session.send")
+    def test_map_bounds_in_flight_requests(self, mock_send):
+        from ponddy_auth.utils import APIClient
+
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def send(request, **kwargs):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.005)
+            with lock:
+                in_flight[0] -= 1
+            if request.url.endswith("/fail"):
+                raise requests.ConnectionError("down")
+            return request.headers["Authorization"]
+
+        mock_send.side_effect = send
+        client = APIClient(app_name=self.APP, api_client_id=self.API, api_secret=self.SECRET)
+        urls = [f"http://app.local/{index}" for index in range(19)] + ["http://app.local/fail"]
+        results = list(
+            client.map(({"method": "GET", "url": url} for url in urls), max_in_flight=3, timeout=1)
+        )
+        self.assertEqual(sorted(result.position for result in results), list(range(20)))
+        self.assertLessEqual(in_flight[1], 3)
+        self.assertEqual(mock_send.call_args[1]["timeout"], 1)
+        errors = [result for result in results if result.error]
+        self.assertEqual([result.position for result in errors], [19])
+        for result in results:
+            if not result.error:
+                self.assertEqual(result.response, client.headers["Authorization"])
+
+    @patch("ponddy_auth.utils.Session.send")
+    def test_map_enforces_the_deadline(self, mock_send):
+        from ponddy_auth.utils import APIClient
+
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        def send(request, **kwargs):
+            if request.url.endswith("/slow"):
+                released.wait(5)
+            return MagicMock()
+
+        mock_send.side_effect = send
+        client = APIClient(app_name=self.APP, api_client_id=self.API, api_secret=self.SECRET)
+        urls = ["http://app.local/slow", "http://app.local/fast"]
+        started = time.monotonic()
+        results = list(client.map(({"method": "GET", "url": url} for url in urls), timeout=0.1))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual([result.position for result in results], [1, 0])
+        self.assertIsInstance(results[1].error, requests.Timeout)
+
+    @patch("ponddy_auth.utils.Session.send")
+    def test_map_sends_the_next_item_once_the_timed_out_one_ends(self, mock_send):
+        from ponddy_auth.utils import APIClient
+
+        def send(request, **kwargs):
+            if request.url.endswith("/slow"):
+                time.sleep(0.3)
+            return MagicMock()
+
+        mock_send.side_effect = send
+        client = APIClient(app_name=self.APP, api_client_id=self.API, api_secret=self.SECRET)
+        urls = ["http://app.local/slow", "http://app.local/fast"]
+        items = ({"method": "GET", "url": url} for url in urls)
+        results = list(client.map(items, max_in_flight=1, timeout=0.1))
+        # The fast one waited for the thread of the slow one, its deadline starts when it is sent
+        self.assertEqual([result.position for result in results], [0, 1])
+        self.assertIsInstance(results[0].error, requests.Timeout)
+        self.assertIsNone(results[1].error)
+        self.assertEqual(mock_send.call_count, 2)
+
+
+class MetricsTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.addCleanup(set_metrics_exporter, get_metrics_exporter())
+        self.exporter = InMemoryExporter()
+        set_metrics_exporter(self.exporter)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_phases_and_outcomes_are_recorded(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        self.assertEqual(self.sso_client.get(reverse("user-list")).status_code, 200)
+        self.assertEqual(self.exporter.get_counter(AUTHENTICATIONS, outcome="success"), 1)
+        self.assertEqual(self.exporter.get_counter(PERMISSION_CHECKS, result="allowed"), 1)
+        for phase in (
+            "header_parsing",
+            "upstream_validation",
+            "user_lookup",
+            "group_resolution",
+            "permission_check",
+        ):
+            self.assertEqual(self.exporter.get_histogram(PHASE_SECONDS, phase=phase).count, 1)
+        self.assertIn(
+            'ponddy_auth_authentications_total{outcome="success"} 1', self.exporter.render()
+        )
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_failures_are_labelled_by_outcome(self, mock_auth):
+        payload = dict(self.get_payload(), api=str(uuid4()))
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(payload)
+        )
+        self.assertEqual(self.sso_client.get(reverse("user-list")).status_code, 401)
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(ok=False, content=b"")
+        self.assertEqual(self.sso_client.get(reverse("user-list")).status_code, 401)
+        mock_auth.side_effect = requests.ConnectionError("down")
+        self.assertEqual(self.sso_client.get(reverse("user-list")).status_code, 401)
+        for outcome in ("missing_group", "invalid_token", "upstream_error"):
+            self.assertEqual(self.exporter.get_counter(AUTHENTICATIONS, outcome=outcome), 1)
+
+
+class ValidationServerTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.server = ValidationServer({self.API: self.SECRET}, payload={"email": self.EMAIL})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def authenticate(self, client):
+        request = HttpRequest()
+        request.META = {f"HTTP_{key.upper()}": val for key, val in client.headers.items()}
+        with override_settings(AUTH_TOKEN_VALID_URL=self.server.url):
+            return SSOAuthentication().authenticate(request)
+
+    def test_validates_api_client_tokens(self):
+        from ponddy_auth.utils import APIClient
+
+        client = APIClient(app_name=self.APP, api_client_id=self.API, api_secret=self.SECRET)
+        user, payload = self.authenticate(client)
+        self.assertEqual(user.email, self.EMAIL)
+        self.assertEqual(payload["api"], self.API)
+        self.assertTrue(getattr(user, "_api_agent").has_perm(self._permission))
+
+        forged = APIClient(app_name=self.APP, api_client_id=self.API, api_secret="FORGED")
+        with self.assertRaises(InvalidToken):
+            self.authenticate(forged)
+        self.server.error_rate = 1
+        with self.assertRaises(AuthServerError):
+            self.authenticate(client)
+        self.assertEqual(tuple(self.server.stats()), (3, 1, 1, 1))
+
+    def test_run_load(self):
+        from ponddy_auth.utils import APIClient
+
+        client = APIClient(app_name=self.APP, api_client_id=self.API, api_secret=self.SECRET)
+        result = run_load(
+            client, self.server.url, requests=20, concurrency=4, sign_every_request=True
+        )
+        self.assertEqual((result.requests, result.failures), (20, 0))
+        self.assertGreater(result.throughput, 0)
+        self.assertLessEqual(result.p50, result.p99)
+
+
+class LazyUserTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        User.objects.create(username=self.EMAIL, email=self.EMAIL)
+        lazy_user = patch.object(SSOAuthentication, "lazy_user", True)
+        lazy_user.start()
+        self.addCleanup(lazy_user.stop)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_user_and_api_agent_are_resolved_on_first_use(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        with self.assertNumQueries(0):
+            user, payload = SSOAuthentication().authenticate(self.get_sso_request())
+            self.assertTrue(user and user.is_authenticated)
+            self.assertFalse(user.is_anonymous)
+            api_agent = getattr(user, "_api_agent")
+        with self.assertNumQueries(1):
+            self.assertEqual(user.email, self.EMAIL)
+        self.assertTrue(api_agent.has_perm(self._permission))
+        self.assertIs(getattr(user, "_api_agent"), api_agent)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_lazy_user_keeps_the_permissions(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        self.assertEqual(self.sso_client.get(reverse("user-list")).status_code, 200)
+        resp = self.sso_client.post(reverse("user-list"), {"username": "newuser"})
+        self.assertEqual(resp.status_code, 403)
+
+        payload = dict(self.get_payload(), api=str(uuid4()))
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(payload)
+        )
+        self.assertEqual(self.sso_client.get(reverse("user-list")).status_code, 401)
+
+
+class APIAgentFirstPermissionTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        agent_first = patch.object(SSODjangoModelPermissions, "api_agent_first", True)
+        agent_first.start()
+        self.addCleanup(agent_first.stop)
+
+    def get_request(self, method, user):
+        from rest_framework.request import Request
+
+        request = self.get_sso_request()
+        request.method = method
+        request = Request(request)
+        request.user = user
+        return request
+
+    def test_agent_grants_without_loading_user_permissions(self):
+        from core.views import UserViewSet
+
+        user = User.objects.create(username=self.EMAIL, email=self.EMAIL)
+        agent = SSOAuthentication().get_api_agent(self.get_payload())
+        setattr(user, "_api_agent", agent)
+        permission, view = SSODjangoModelPermissions(), UserViewSet()
+        request = self.get_request("GET", user)
+        with self.assertNumQueries(0):
+            self.assertTrue(permission.has_permission(request, view))
+        with patch.object(agent, "has_perms") as has_perms:
+            self.assertTrue(permission.has_permission(request, view))
+        has_perms.assert_not_called()
+
+        request = self.get_request("POST", user)
+        with self.assertNumQueries(2):
+            self.assertFalse(permission.has_permission(request, view))
+        user.user_permissions.add(Permission.objects.get(codename="add_user"))
+        request = self.get_request("POST", User.objects.get(pk=user.pk))
+        setattr(request.user, "_api_agent", agent)
+        self.assertTrue(permission.has_permission(request, view))
+
+
+class ObjectPermissionTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.granted = [User.objects.create(username=f"granted{index}") for index in range(3)]
+        self.api.user_set.add(*self.granted)
+        self.hidden = User.objects.create(username="hidden")
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_list_is_filtered_in_one_query(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps({"api": self.API})
+        )
+        resp = self.sso_client.get(reverse("agent-user-list"))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [user["username"] for user in resp.json()], [user.username for user in self.granted]
+        )
+        url = reverse("agent-user-detail", args=[self.granted[0].pk])
+        self.assertEqual(self.sso_client.get(url).status_code, 200)
+        url = reverse("agent-user-detail", args=[self.hidden.pk])
+        self.assertEqual(self.sso_client.get(url).status_code, 404)
+
+    def test_object_permission_of_unfiltered_objects(self):
+        from rest_framework.request import Request
+
+        from core.views import AgentUserViewSet
+        from ponddy_auth.permissions import SSODjangoObjectPermissions
+
+        request = Request(self.get_sso_request())
+        request.method = "GET"
+        request.user = AnonymousUser()
+        setattr(request.user, "_api_agent", SSOAuthentication().get_api_agent(self.get_payload()))
+        permission, view = SSODjangoObjectPermissions(), AgentUserViewSet()
+        with self.assertNumQueries(1):
+            self.assertTrue(permission.has_object_permission(request, view, self.granted[0]))
+        self.assertFalse(permission.has_object_permission(request, view, self.hidden))
+        queryset = permission.filter_queryset(request, User.objects.all(), view)
+        with self.assertNumQueries(1):
+            for user in queryset:
+                self.assertTrue(permission.has_object_permission(request, view, user))
+
+
+class SharedCacheTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        caches["default"].clear()
+
+    def get_token_cache(self):
+        return DjangoCache("default", "token", ttl=60, encode=json.dumps, decode=json.loads)
+
+    @patch("ponddy_auth.transport.Session.get")
+    def test_workers_share_one_validation(self, mock_auth):
+        mock_auth.side_effect = lambda *arg, **kwargs: MockAuthHTTPResponse(
+            content=json.dumps(self.get_payload())
+        )
+        for _ in range(2):
+            # Every worker has its own cache object over the same backend
+            with patch.object(SSOAuthentication, "token_cache", self.get_token_cache()):
+                SSOAuthentication().authenticate(self.get_sso_request())
+        self.assertEqual(mock_auth.call_count, 1)
+        keys = " ".join(caches["default"]._cache)
+        self.assertNotIn(self.token, keys)
+
+        self.get_token_cache().clear()
+        with patch.object(SSOAuthentication, "token_cache", self.get_token_cache()):
+            SSOAuthentication().authenticate(self.get_sso_request())
+        self.assertEqual(mock_auth.call_count, 2)
+
+    def test_api_agents_are_shared_and_invalidated(self):
+        from ponddy_auth import agents
+
+        cache = DjangoCache(
+            "default",
+            "api_agent",
+            ttl=60,
+            encode=agents.encode_api_agent,
+            decode=agents.decode_api_agent,
+        )
+        with patch.object(agents, "api_agent_cache", cache):
+            agents.resolve_api_agent(self.api.name)
+            with self.assertNumQueries(0):
+                api_agent = agents.resolve_api_agent(self.api.name)
+            attach_permission_functions(api_agent)
+            self.assertTrue(api_agent.has_perm(self._permission))
+            self.api.permissions.remove(self.permission)
+            api_agent = agents.resolve_api_agent(self.api.name)
+            attach_permission_functions(api_agent)
+            self.assertFalse(api_agent.has_perm(self._permission))
+
+
+class PermissionIndexTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+
+    def test_grants_are_bits_of_permission_keys(self):
+        from ponddy_auth.agents import permission_index, resolve_api_agent
+
+        self.addCleanup(permission_index.reset)
+        agent = resolve_api_agent(self.api.name)
+        attach_permission_functions(agent)
+        self.assertEqual(getattr(agent, "_perm_cache"), 1 << self.permission.pk)
+        self.assertTrue(agent.has_perms([self._permission]))
+        self.assertFalse(agent.has_perms([self._permission, "auth.add_user"]))
+        self.assertFalse(agent.has_perm("auth.unknown"))
+
+        self.permission.codename = "read_user"
+        self.permission.save()
+        with self.assertNumQueries(0):
+            self.assertTrue(agent.has_perm("auth.read_user"))
+            self.assertFalse(agent.has_perm(self._permission))
+
+        # A permission the index does not know, as if another process created it, reloads it
+        permission_index.remove(self.permission.pk)
+        permission_index._loaded_at = 0
+        self.assertTrue(agent.has_perm("auth.read_user"))
+
+    def test_mask_of_replaced_bits_is_not_kept(self):
+        from ponddy_auth.agents import PermissionIndex
+
+        index = PermissionIndex()
+        bits = index.load()
+        index.remove(self.permission.pk)
+        # As if the lookup read the bits before another thread removed the permission
+        with patch.object(index, "get_bits", return_value=bits):
+            self.assertEqual(index.get_mask([self._permission]), 1 << self.permission.pk)
+        self.assertIsNone(index.get_mask([self._permission]))
+
+
+class PreloadAPIAgentTest(TestAPIMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.set_up_api()
+        self.addCleanup(setattr, agents, "api_agent_snapshot", agents.api_agent_snapshot)
+
+    def test_preloaded_agents_run_no_query(self):
+        out = StringIO()
+        call_command("preload_api_agents", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Preloaded 1 API agents")
+        with self.assertNumQueries(0):
+            api_agent = SSOAuthentication().get_api_agent(self.get_payload())
+            self.assertTrue(api_agent.has_perm(self._permission))
+
+        self.api.permissions.remove(self.permission)
+        with self.assertNumQueries(1):
+            self.assertFalse(
+                SSOAuthentication().get_api_agent(self.get_payload()).has_perm(self._permission)
+            )
+
+    def test_agents_created_later_are_resolved(self):
+        agents.preload_api_agents()
+        api = str(uuid4())
+        Group.objects.create(name=f"{API_AGENT_PREFIX}_{api}")
+        self.assertNotIn(f"{API_AGENT_PREFIX}_{api}", agents.api_agent_snapshot.agents)
+        self.assertEqual(
+            SSOAuthentication().get_api_agent({"api": api}).name, f"{API_AGENT_PREFIX}_{api}"
+        )
+        with self.assertRaises(TypeError):
+            agents.api_agent_snapshot.agents["name"] = None
+
+    def test_ready_preloads_only_in_the_server_process(self):
+        from django.apps import apps
+
+        config = apps.get_app_config("ponddy_auth")
+        with patch.object(agents, "preload_api_agents") as preload:
+            config.ready()
+            preload.assert_not_called()
+            with patch.dict("os.environ", {"PONDDY_AUTH_PRELOAD_API_AGENTS": "1"}):
+                config.ready()
+            preload.assert_called_once_with(freeze=True)
+
+    def test_freeze_closes_the_connections_before_the_fork(self):
+        calls = []
+        with patch("ponddy_auth.agents.connections") as connections, patch(
+            "gc.freeze", side_effect=lambda: calls.append("freeze")
+        ):
+            connections.close_all.side_effect = lambda: calls.append("close_all")
+            agents.preload_api_agents(freeze=True)
+        self.assertEqual(calls, ["close_all", "freeze"])
+
+
+class AuthEventLogTest(TestCase):
+    def test_successes_are_sampled_and_failures_are_capped(self):
+        from ponddy_auth import log
+
+        authentication = SSOAuthentication()
+        with patch.object(log, "LOG_SUCCESS_SAMPLE_RATE", 0), patch.object(
+            log, "LOG_MAX_FIELD_LENGTH", 16
+        ), self.assertLogs("ponddy_auth", "INFO") as logs:
+            authentication.parse_validation_response(True, 200, '{"email": "a@b.c"}')
+            with self.assertRaises(AuthenticationFailed):
+                authentication.parse_validation_response(False, 401, "x" * 100)
+            # The event is formatted lazily, when a handler reads the message
+            self.assertEqual(len(logs.records), 1)
+            self.assertEqual(
+                json.loads(logs.records[0].getMessage()),
+                {
+                    "event": "validation",
+                    "status": 401,
+                    "outcome": "invalid_token",
+                    "body": "x" * 16 + "...(100 chars)",
+                },
+            )
+
+    def test_queue_handler_emits_off_thread(self):
+        import logging
+
+        from ponddy_auth import log
+
+        logger = logging.getLogger("ponddy_auth.tests.queue")
+        logger.setLevel(logging.INFO)
+        emitted = []
+        formatted = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                self.format(record)
+                emitted.append(threading.current_thread())
+
+        class Event:
+            def __str__(self):
+                formatted.append(threading.current_thread())
+                return "event"
+
+        logger.addHandler(Handler())
+        self.addCleanup(setattr, log, "_listener", None)
+        self.addCleanup(setattr, log, "_queue_handler", None)
+        self.addCleanup(log.stop_listener)
+        listener = log.install_queue_handler(logger)
+        parent_handler = Handler()
+        logger.parent.addHandler(parent_handler)
+        self.addCleanup(logger.parent.removeHandler, parent_handler)
+        logger.info("%s", Event())
+        listener.stop()
+        self.assertEqual(len(emitted), 2)
+        self.assertTrue(formatted)
+        self.assertNotIn(threading.current_thread(), emitted + formatted)
+
+        # As in a forked child, where the thread of the listener is gone
+        log._restart_listener()
+        self.assertIsNot(log._listener, listener)
+        logger.info("event")
+        log.stop_listener()
+        self.assertEqual(len(emitted), 4)
@@ -23,6 +23,7 @@ from . import views
 
 router = routers.DefaultRouter()
 router.register(r"users", views.UserViewSet)
+router.register(r"agent-users", views.AgentUserViewSet, basename="agent-user")
 
 
 urlpatterns = [path("", include(router.urls))]
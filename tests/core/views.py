@@ -1,7 +1,11 @@
 from django.contrib.auth.models import User
 from rest_framework import viewsets
 
-from ponddy_auth.permissions import SSODjangoModelPermissions
+from ponddy_auth.permissions import (
+    SSOAPIAgentFilterBackend,
+    SSODjangoModelPermissions,
+    SSODjangoObjectPermissions,
+)
 
 from .serializers import UserSerializer
 
@@ -14,3 +18,13 @@ class UserViewSet(viewsets.ModelViewSet):
     permission_classes = [
         SSODjangoModelPermissions,
     ]
+
+
+class AgentUserViewSet(viewsets.ReadOnlyModelViewSet):
+    """API endpoint that allows API agents to view the users of their groups only."""
+
+    queryset = User.objects.all().order_by("pk")
+    serializer_class = UserSerializer
+    permission_classes = [SSODjangoObjectPermissions]
+    filter_backends = [SSOAPIAgentFilterBackend]
+    api_agent_lookup_field = "groups"